@@ -6,10 +6,15 @@
 # file 'LICENSE', which is part of this source code package.
 
 import json
+import os
 import requests
 import sys
 import logging
 import base64
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlunparse
 
 # The hostname of the ExtraHop system you are migrating detection
@@ -27,6 +32,27 @@ TARGET_ID = "abcdefg123456789"
 TARGET_SECRET = "123456789abcdefg987654321abcdefg"
 
 
+# Number of devices to look up per /devices/search request
+SEARCH_CHUNK_SIZE = 100
+# Number of rules to create on the target at the same time
+MAX_WORKERS = 8
+# Maximum number of rules to create on the target per second
+MAX_RULES_PER_SECOND = 10
+# Rule fields that are set by the ExtraHop system rather than copied from the
+# source rule, and are ignored when comparing rules
+GENERATED_RULE_FIELDS = ["id", "author", "create_time", "mod_time"]
+# Directory for the files written and read when the script is run in steps:
+#   snapshot - save the source rules and the source and target devices,
+#              device groups and network localities
+#   plan     - remap the rules from the snapshot without contacting either
+#              system, and save the plan and a report of unresolved participants
+#   apply    - create the rules in the plan on Reveal(x) 360
+# Run the script without arguments to migrate in a single step.
+SNAPSHOT_DIR = "detection_hiding_snapshot"
+# Participant types whose IDs are remapped to the target
+REMAPPED_TYPES = ["device", "device_group", "network_locality"]
+
+
 def getRules():
     """
     Method that retrieves detection hiding rules from the source
@@ -75,62 +101,122 @@ def getToken():
     return r.json()["access_token"]
 
 
-def replaceId(participant, token):
+# Per-run memo of source ID -> target ID mappings, keyed by (object type,
+# source ID), with [hits, misses] per object type
+lookup_cache = {}
+lookup_stats = {}
+
+
+def cachedLookup(kind, object_id, lookup):
     """
-    Method that replaces a device or device group ID in a participant object with the
-    equivalent ID on Reveal(x) 360.
+    Method that returns the result of lookup() for a source object,
+    calling it only the first time the object is seen in this run.
+
+        Parameters:
+            kind (str): The kind of lookup, such as "device" or "device_group"
+            object_id (int): The numerical identifier of the source object
+            lookup (function): The function that performs the lookup
+
+        Returns:
+            The result of the lookup
+    """
+    stats = lookup_stats.setdefault(kind, [0, 0])
+    if (kind, object_id) in lookup_cache:
+        stats[0] += 1
+        return lookup_cache[(kind, object_id)]
+    stats[1] += 1
+    result = lookup()
+    lookup_cache[(kind, object_id)] = result
+    return result
+
+
+def findTargetId(participant, token):
+    """
+    Method that finds the ID on Reveal(x) 360 of the device, device group
+    or network locality in a participant object.
 
         Parameters:
             participant (dict): The participant object
             token (str): A temporary access token for Reveal(x) 360 authentication
         Returns:
-            participant (dict): The updated participant object
+            int: The numerical ID of the equivalent object, or -1 if there
+            is none
     """
+    object_id = participant["object_id"]
     if participant["object_type"] == "device":
-        macaddr = getMac(participant["object_id"])
+        macaddr = getMac(object_id)
         if macaddr == None:
-            return {}
-        else:
-            new_id = getDevId(macaddr, token)
-        if new_id == -1:
-            return {}
-        else:
-            participant["object_id"] = new_id
+            return -1
+        return getDevId(macaddr, token)
     elif participant["object_type"] == "device_group":
-        group_name = getName(participant["object_id"])
+        group_name = getName(object_id)
         if group_name == "":
-            return {}
-        else:
-            new_id = getGroupId(group_name, token)
-        if new_id == -1:
-            return {}
-        else:
-            participant["object_id"] = new_id
+            return -1
+        return getGroupId(group_name, token)
     elif participant["object_type"] == "network_locality":
-        networks = getNetworks(participant["object_id"])
+        networks = getNetworks(object_id)
         if networks == []:
-            return {}
-        else:
-            new_id = getLocalityId(networks, token)
-        if new_id == -1:
-            return {}
-        else:
-            participant["object_id"] = new_id
+            return -1
+        return getLocalityId(networks, token)
+    return object_id
+
+
+def replaceId(participant, token):
+    """
+    Method that replaces a device or device group ID in a participant object with the
+    equivalent ID on Reveal(x) 360. Each source object is only resolved once
+    per run.
+
+        Parameters:
+            participant (dict): The participant object
+            token (str): A temporary access token for Reveal(x) 360 authentication
+        Returns:
+            participant (dict): The updated participant object
+    """
+    new_id = cachedLookup(
+        participant["object_type"],
+        participant["object_id"],
+        lambda: findTargetId(participant, token),
+    )
+    if new_id == -1:
+        return {}
+    participant["object_id"] = new_id
     return participant
 
 
-def getLocalityId(networks, token):
+# Index of the network localities on Reveal(x) 360, built on first use:
+# frozenset of networks -> locality ID
+locality_index = None
+
+
+def indexLocalities(localities):
     """
-    Method that searches Reveal(x) 360 for a network locality
-    that contains all of the specified networks and returns
-    the ID of that locality.
+    Method that indexes network localities by their networks.
+
+        Parameters:
+            localities (list): The network locality objects
+
+        Returns:
+            dict: The locality IDs by frozenset of networks
+    """
+    index = {}
+    for locality in localities:
+        # Keep the first locality with a given set of networks
+        index.setdefault(frozenset(locality["networks"]), locality["id"])
+    return index
+
+
+def getLocalityIndex(token):
+    """
+    Method that retrieves all network localities from Reveal(x) 360
+    and indexes them by their networks.
 
         Parameters:
-            networks (list): A list of CIDR blocks and IP addresses
             token (str): A temporary access token for Reveal(x) 360 authentication
 
         Returns:
-            int: The numerical ID of the network locality
+            dict: The locality IDs by frozenset of networks, or None if the
+            localities could not be retrieved
     """
     url = urlunparse(
         ("https", TARGET_HOST, "/api/v1/networklocalities", "", "", "")
@@ -141,20 +227,41 @@ def getLocalityId(networks, token):
     }
     r = requests.get(url, headers=headers)
     if r.status_code == 200:
-        for locality in r.json():
-            if set(networks) == set(locality["networks"]):
-                return locality["id"]
-        logging.warning(
-            f"No equivalent network locality exists on Reveal(x)360 with the following IP addresses and CIDR blocks {networks}"
-        )
-        return -1
+        return indexLocalities(r.json())
     else:
         logging.warning(r.status_code)
         logging.warning(r.text)
         logging.warning(
             f"Unable to retrieve network localities from Reveal(x) 360"
         )
+        return None
+
+
+def getLocalityId(networks, token):
+    """
+    Method that searches Reveal(x) 360 for a network locality
+    that contains all of the specified networks and returns
+    the ID of that locality.
+
+        Parameters:
+            networks (list): A list of CIDR blocks and IP addresses
+            token (str): A temporary access token for Reveal(x) 360 authentication
+
+        Returns:
+            int: The numerical ID of the network locality
+    """
+    global locality_index
+    if locality_index is None:
+        locality_index = getLocalityIndex(token)
+        if locality_index is None:
+            return -1
+    locality_id = locality_index.get(frozenset(networks))
+    if locality_id is None:
+        logging.warning(
+            f"No equivalent network locality exists on Reveal(x)360 with the following IP addresses and CIDR blocks {networks}"
+        )
         return -1
+    return locality_id
 
 
 def getNetworks(locality_id):
@@ -167,6 +274,10 @@ def getNetworks(locality_id):
         Returns:
             list: The list of IP addresses and CIDR blocks
     """
+    if locality_id in source_locality_networks:
+        if source_locality_networks[locality_id] == []:
+            logging.warning(f"Unable to retrieve networks for {locality_id}")
+        return source_locality_networks[locality_id]
     url = urlunparse(
         (
             "https",
@@ -191,6 +302,152 @@ def getNetworks(locality_id):
         return []
 
 
+# Device participants resolved in bulk by prefetchDevices(): source devices
+# by ID (None if not found), and target devices by lowercase MAC address
+source_devices = {}
+target_devices = {}
+# Names of source device groups and networks of source network localities
+# loaded from a snapshot, by ID ("" or [] if not found)
+source_group_names = {}
+source_locality_networks = {}
+
+
+def searchDevices(host, headers, field, values):
+    """
+    Method that searches for devices whose field equals one of the
+    specified values, with one request per SEARCH_CHUNK_SIZE values.
+
+        Parameters:
+            host (str): The hostname of the ExtraHop system
+            headers (dict): The request headers for the ExtraHop system
+            field (str): The device field to filter by
+            values (list): The values to search for
+
+        Returns:
+            list: The matching devices, or None if a search failed
+    """
+    url = urlunparse(("https", host, "/api/v1/devices/search", "", "", ""))
+    devices = []
+    for i in range(0, len(values), SEARCH_CHUNK_SIZE):
+        chunk = values[i : i + SEARCH_CHUNK_SIZE]
+        data = {
+            "filter": {
+                "operator": "or",
+                "rules": [
+                    {"field": field, "operand": str(value), "operator": "="}
+                    for value in chunk
+                ],
+            },
+            # A MAC address can belong to both an L2 and an L3 device
+            "limit": 10 * len(chunk),
+        }
+        r = requests.post(url, headers=headers, json=data)
+        if r.status_code == 200:
+            devices.extend(r.json())
+        else:
+            logging.warning(r.status_code)
+            logging.warning(r.text)
+            logging.warning(f"Unable to search devices on {host}")
+            return None
+    return devices
+
+
+def getParticipantIds(rules, object_type):
+    """
+    Method that returns the IDs of the participants of a given type in
+    a list of rules.
+
+        Parameters:
+            rules (list): The rules to be migrated
+            object_type (str): The participant type, such as "device"
+
+        Returns:
+            set: The numerical IDs of the participants
+    """
+    object_ids = set()
+    for rule in rules:
+        for role in ["victim", "offender"]:
+            participant = rule[role]
+            if (
+                participant != "Any"
+                and participant["object_type"] == object_type
+            ):
+                object_ids.add(participant["object_id"])
+    return object_ids
+
+
+def loadSourceDevices(dev_ids, devices):
+    """
+    Method that stores the source devices of device participants.
+
+        Parameters:
+            dev_ids (set): The IDs of the device participants
+            devices (list): The source devices that were found
+
+        Returns:
+            list: The lowercase MAC addresses of the devices that were found
+    """
+    found = {device["id"]: device for device in devices}
+    for dev_id in dev_ids:
+        source_devices[dev_id] = found.get(dev_id)
+    return sorted(
+        {
+            device["macaddr"].lower()
+            for device in found.values()
+            if device.get("macaddr")
+        }
+    )
+
+
+def loadTargetDevices(macaddrs, devices):
+    """
+    Method that stores the target devices by MAC address.
+
+        Parameters:
+            macaddrs (list): The lowercase MAC addresses that were searched for
+            devices (list): The target devices that were found
+    """
+    for macaddr in macaddrs:
+        target_devices[macaddr] = []
+    for device in devices:
+        macaddr = (device.get("macaddr") or "").lower()
+        if macaddr in target_devices:
+            target_devices[macaddr].append(device)
+
+
+def prefetchDevices(rules, token):
+    """
+    Method that resolves the device participants of all rules in bulk:
+    the MAC addresses of the source devices, and the devices on
+    Reveal(x) 360 with those MAC addresses. Devices that could not be
+    prefetched are looked up one at a time by getMac and getDevId.
+
+        Parameters:
+            rules (list): The rules to be migrated
+            token (str): A temporary access token for Reveal(x) 360 authentication
+    """
+    source_headers = {
+        "Authorization": f"ExtraHop apikey={SOURCE_API_KEY}",
+        "Content-Type": "application/json",
+    }
+    target_headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+    dev_ids = getParticipantIds(rules, "device")
+    if not dev_ids:
+        return
+    logging.info(f"Resolving {len(dev_ids)} device participants")
+    devices = searchDevices(SOURCE_HOST, source_headers, "id", sorted(dev_ids))
+    if devices is None:
+        return
+    macaddrs = loadSourceDevices(dev_ids, devices)
+    devices = searchDevices(TARGET_HOST, target_headers, "macaddr", macaddrs)
+    if devices is None:
+        return
+    loadTargetDevices(macaddrs, devices)
+
+
 def getMac(dev_id):
     """
     Method that retrieves the MAC address for a device
@@ -201,6 +458,12 @@ def getMac(dev_id):
         Returns:
             str: The MAC address of the device
     """
+    if dev_id in source_devices:
+        device = source_devices[dev_id]
+        if device:
+            return device["macaddr"]
+        logging.warning(f"Unable to retrieve MAC address for {dev_id}")
+        return None
     url = urlunparse(
         ("https", SOURCE_HOST, f"/api/v1/devices/{dev_id}", "", "", "")
     )
@@ -218,6 +481,35 @@ def getMac(dev_id):
         return None
 
 
+def pickDevId(devices, macaddr):
+    """
+    Method that picks the device that a participant with a given MAC
+    address maps to on Reveal(x) 360.
+
+        Parameters:
+            devices (list): The devices with the MAC address
+            macaddr (str): The MAC address of the device
+
+        Returns:
+            int: The numerical ID of the device
+    """
+    if len(devices) == 0:
+        logging.warning(
+            f"No equivalent device exists on Reveal(x)360 for {macaddr}"
+        )
+        return -1
+    if len(devices) > 1:
+        # If there are more than one device with the given MAC address, return
+        # the L2 device.
+        for device in devices:
+            if device["is_l3"] == False:
+                return device["id"]
+        logging.warning(f"No L2 device found for {macaddr}")
+        return -1
+    else:
+        return devices[0]["id"]
+
+
 def getDevId(macaddr, token):
     """
     Method that returns the ID of a device with a given MAC address on Reveal(x) 360
@@ -229,6 +521,8 @@ def getDevId(macaddr, token):
         Returns:
             int: The numerical ID of the device
     """
+    if macaddr.lower() in target_devices:
+        return pickDevId(target_devices[macaddr.lower()], macaddr)
     url = urlunparse(
         ("https", TARGET_HOST, "/api/v1/devices/search", "", "", "")
     )
@@ -239,22 +533,7 @@ def getDevId(macaddr, token):
     data = {"filter": {"field": "macaddr", "operand": macaddr, "operator": "="}}
     r = requests.post(url, headers=headers, json=data)
     if r.status_code == 200:
-        devices = r.json()
-        if len(devices) == 0:
-            logging.warning(
-                f"No equivalent device exists on Reveal(x)360 for {macaddr}"
-            )
-            return -1
-        if len(devices) > 1:
-            # If there are more than one device with the given MAC address, return
-            # the L2 device.
-            for device in devices:
-                if device["is_l3"] == False:
-                    return device["id"]
-            logging.warning(f"No L2 device found for {macaddr}")
-            return -1
-        else:
-            return devices[0]["id"]
+        return pickDevId(r.json(), macaddr)
     else:
         logging.warning(r.status_code)
         logging.warning(r.text)
@@ -272,6 +551,10 @@ def getName(group_id):
         Returns:
             str: The name of the device group
     """
+    if group_id in source_group_names:
+        if source_group_names[group_id] == "":
+            logging.warning(f"Unable to retrieve name for {group_id}")
+        return source_group_names[group_id]
     url = urlunparse(
         ("https", SOURCE_HOST, f"/api/v1/devicegroups/{group_id}", "", "", "")
     )
@@ -289,16 +572,39 @@ def getName(group_id):
         return ""
 
 
-def getGroupId(group_name, token):
+# Index of the device groups on Reveal(x) 360, built on first use:
+# group name -> group ID
+group_index = None
+
+
+def indexGroups(groups):
     """
-    Method that returns the ID of a device group with a given name
+    Method that indexes device groups by name.
+
+        Parameters:
+            groups (list): The device group objects
+
+        Returns:
+            dict: The group IDs by name
+    """
+    index = {}
+    for group in groups:
+        # Keep the first group with a given name
+        index.setdefault(group["name"], group["id"])
+    return index
+
+
+def getGroupIndex(token):
+    """
+    Method that retrieves all device groups from Reveal(x) 360
+    and indexes them by name.
 
         Parameters:
-            group_name (str): The name of the device group
             token (str): A temporary access token for Reveal(x) 360 authentication
 
         Returns:
-            int: The ID of the device group
+            dict: The group IDs by name, or None if the device groups could
+            not be retrieved
     """
     url = urlunparse(("https", TARGET_HOST, "/api/v1/devicegroups", "", "", ""))
     headers = {
@@ -307,19 +613,115 @@ def getGroupId(group_name, token):
     }
     r = requests.get(url, headers=headers)
     if r.status_code == 200:
-        groups = r.json()
-        for group in groups:
-            if group["name"] == group_name:
-                return group["id"]
-        logging.warning(
-            f"Unable to find an equivalent device group for {group_name}"
-        )
-        return -1
+        return indexGroups(r.json())
     else:
         logging.warning(r.status_code)
         logging.warning(r.text)
         logging.warning(f"Unable to retrieve device groups")
+        return None
+
+
+def getGroupId(group_name, token):
+    """
+    Method that returns the ID of a device group with a given name
+
+        Parameters:
+            group_name (str): The name of the device group
+            token (str): A temporary access token for Reveal(x) 360 authentication
+
+        Returns:
+            int: The ID of the device group
+    """
+    global group_index
+    if group_index is None:
+        group_index = getGroupIndex(token)
+        if group_index is None:
+            return -1
+    group_id = group_index.get(group_name)
+    if group_id is None:
+        logging.warning(
+            f"Unable to find an equivalent device group for {group_name}"
+        )
         return -1
+    return group_id
+
+
+def getTargetRules(token):
+    """
+    Method that retrieves the detection hiding rules that already
+    exist on Reveal(x) 360.
+
+        Parameters:
+            token (str): A temporary access token for Reveal(x) 360 authentication
+
+        Returns:
+            rules (list): List of rule objects
+    """
+    url = urlunparse(
+        ("https", TARGET_HOST, "/api/v1/detections/rules/hiding", "", "", "")
+    )
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+    r = requests.get(url, headers=headers)
+    if r.status_code == 200:
+        return r.json()
+    else:
+        logging.error(r.status_code)
+        logging.error(r.text)
+        raise RuntimeError("Unable to retrieve rules from the target")
+
+
+def ruleFingerprint(rule):
+    """
+    Method that returns a fingerprint of the content of a rule, which is
+    the same for a migrated rule and its copy on Reveal(x) 360.
+
+        Parameters:
+            rule (dict): The rule properties.
+
+        Returns:
+            str: The fingerprint
+    """
+    content = {
+        key: value
+        for key, value in rule.items()
+        if key not in GENERATED_RULE_FIELDS and value is not None
+    }
+    for role in ["victim", "offender"]:
+        participant = content.get(role)
+        if isinstance(participant, dict) and "object_locality" in participant:
+            # updateParticipants copies object_value to object_locality for
+            # locality_type participants, but rules retrieved from the
+            # target only have object_value
+            participant = dict(participant)
+            locality = participant.pop("object_locality")
+            participant.setdefault("object_value", locality)
+            content[role] = participant
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+rate_limit_lock = threading.Lock()
+next_request_time = 0
+
+
+def waitForRateLimit():
+    """
+    Method that blocks until another rule can be created without
+    exceeding MAX_RULES_PER_SECOND.
+    """
+    global next_request_time
+    with rate_limit_lock:
+        now = time.monotonic()
+        wait = next_request_time - now
+        next_request_time = (
+            max(now, next_request_time) + 1 / MAX_RULES_PER_SECOND
+        )
+    if wait > 0:
+        time.sleep(wait)
 
 
 def makeRule(rule, token):
@@ -348,6 +750,7 @@ def makeRule(rule, token):
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
     }
+    waitForRateLimit()
     r = requests.post(url, headers=headers, json=rule)
     if r.status_code == 201:
         logging.info(f"Successfully migrated rule {rule_id}")
@@ -394,20 +797,235 @@ def updateParticipants(rule, token):
     return rule
 
 
-def main():
-    rules = getRules()
-    num_rules = str(len(rules))
-    logging.info(f"Migrating {num_rules} detection hiding rules")
-    token = getToken()
-    # Find equivalent IDs for participants
+def createRules(rules, token):
+    """
+    Method that creates rules on Reveal(x) 360 with up to MAX_WORKERS
+    requests at a time. Rules with the same content as a rule that already
+    exists on Reveal(x) 360, such as rules created by a previous run,
+    are skipped.
+
+        Parameters:
+            rules (list): The rules to be created
+            token (str): A temporary access token for Reveal(x) 360 authentication
+    """
+    fingerprints = set(ruleFingerprint(rule) for rule in getTargetRules(token))
+    new_rules = []
+    for rule in rules:
+        fingerprint = ruleFingerprint(rule)
+        if fingerprint in fingerprints:
+            logging.info(f"Rule {rule['id']} already exists on the target")
+            continue
+        fingerprints.add(fingerprint)
+        new_rules.append(rule)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(
+            executor.map(lambda rule: makeRule(rule, token), new_rules)
+        )
+    logging.info(
+        f"Created {results.count(True)} rules, skipped "
+        f"{len(rules) - len(new_rules)} existing rules, "
+        f"{results.count(False)} failed"
+    )
+
+
+def resolveRules(rules, token):
+    """
+    Method that finds equivalent IDs for the participants of rules.
+
+        Parameters:
+            rules (list): The rules to be migrated
+            token (str): A temporary access token for Reveal(x) 360 authentication
+
+        Returns:
+            list: The updated rules whose participants were all found
+            list: The rules with participants that were not found, each
+            with the rule ID and the unresolved participants
+    """
     updated_rules = []
-    not_found = []
+    unresolved = []
     for rule in rules:
+        participants = {
+            role: rule[role] if rule[role] == "Any" else dict(rule[role])
+            for role in ["victim", "offender"]
+        }
         new_rule = updateParticipants(rule, token)
         if new_rule:
             updated_rules.append(new_rule)
-        else:
-            not_found.append(rule["id"])
+            continue
+        missing = []
+        for role, participant in participants.items():
+            if (
+                participant == "Any"
+                or participant["object_type"] not in REMAPPED_TYPES
+            ):
+                continue
+            key = (participant["object_type"], participant["object_id"])
+            # updateParticipants stops at the first participant that is not
+            # found, so the other one may not have been looked up yet.
+            if key not in lookup_cache:
+                replaceId(dict(participant), token)
+            if lookup_cache[key] == -1:
+                missing.append(dict(participant, role=role))
+        unresolved.append({"rule_id": rule["id"], "participants": missing})
+    for kind, (hits, misses) in sorted(lookup_stats.items()):
+        logging.info(f"{kind} lookups: {hits} cache hits, {misses} misses")
+    return updated_rules, unresolved
+
+
+def writeSnapshotFile(name, data):
+    """
+    Method that writes data to a JSON file in SNAPSHOT_DIR.
+
+        Parameters:
+            name (str): The name of the file, without the extension
+            data: The data to be written
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(SNAPSHOT_DIR, f"{name}.json")
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+    logging.info(f"Wrote {path}")
+
+
+def readSnapshotFile(name):
+    """
+    Method that reads data from a JSON file in SNAPSHOT_DIR.
+
+        Parameters:
+            name (str): The name of the file, without the extension
+
+        Returns:
+            The data in the file
+    """
+    with open(os.path.join(SNAPSHOT_DIR, f"{name}.json")) as f:
+        return json.load(f)
+
+
+def getObjects(host, headers, path):
+    """
+    Method that retrieves all objects from an ExtraHop system endpoint,
+    such as /api/v1/devicegroups.
+
+        Parameters:
+            host (str): The hostname of the ExtraHop system
+            headers (dict): The request headers for the ExtraHop system
+            path (str): The path of the endpoint
+
+        Returns:
+            list: The objects
+    """
+    url = urlunparse(("https", host, path, "", "", ""))
+    r = requests.get(url, headers=headers)
+    if r.status_code == 200:
+        return r.json()
+    else:
+        logging.error(r.status_code)
+        logging.error(r.text)
+        raise RuntimeError(f"Unable to retrieve {path} from {host}")
+
+
+def takeSnapshot(token):
+    """
+    Method that saves the source rules, and the source and target devices,
+    device groups and network localities that are needed to migrate them,
+    to SNAPSHOT_DIR. Only the devices that are rule participants, and the
+    target devices with the same MAC addresses, are saved.
+
+        Parameters:
+            token (str): A temporary access token for Reveal(x) 360 authentication
+    """
+    source_headers = {
+        "Authorization": f"ExtraHop apikey={SOURCE_API_KEY}",
+        "Content-Type": "application/json",
+    }
+    target_headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+    rules = getRules()
+    logging.info(f"Taking a snapshot for {len(rules)} detection hiding rules")
+    dev_ids = getParticipantIds(rules, "device")
+    source_found = searchDevices(
+        SOURCE_HOST, source_headers, "id", sorted(dev_ids)
+    )
+    if source_found is None:
+        raise RuntimeError("Unable to retrieve source devices")
+    macaddrs = loadSourceDevices(dev_ids, source_found)
+    target_found = searchDevices(
+        TARGET_HOST, target_headers, "macaddr", macaddrs
+    )
+    if target_found is None:
+        raise RuntimeError("Unable to retrieve target devices")
+    snapshot = {
+        "source_rules": rules,
+        "source_devices": source_found,
+        "source_device_groups": getObjects(
+            SOURCE_HOST, source_headers, "/api/v1/devicegroups"
+        ),
+        "source_network_localities": getObjects(
+            SOURCE_HOST, source_headers, "/api/v1/networklocalities"
+        ),
+        "target_devices": target_found,
+        "target_device_groups": getObjects(
+            TARGET_HOST, target_headers, "/api/v1/devicegroups"
+        ),
+        "target_network_localities": getObjects(
+            TARGET_HOST, target_headers, "/api/v1/networklocalities"
+        ),
+    }
+    for name, data in snapshot.items():
+        writeSnapshotFile(name, data)
+
+
+def planMigration():
+    """
+    Method that remaps the rules in the snapshot without contacting
+    either ExtraHop system, and saves the rules to be created to plan.json
+    and the rules with unresolved participants to unresolved.json.
+    """
+    global group_index, locality_index
+    rules = readSnapshotFile("source_rules")
+    logging.info(
+        f"Planning the migration of {len(rules)} detection hiding rules"
+    )
+    dev_ids = getParticipantIds(rules, "device")
+    macaddrs = loadSourceDevices(dev_ids, readSnapshotFile("source_devices"))
+    loadTargetDevices(macaddrs, readSnapshotFile("target_devices"))
+    names = {
+        group["id"]: group["name"]
+        for group in readSnapshotFile("source_device_groups")
+    }
+    for group_id in getParticipantIds(rules, "device_group"):
+        source_group_names[group_id] = names.get(group_id, "")
+    networks = {
+        locality["id"]: locality["networks"]
+        for locality in readSnapshotFile("source_network_localities")
+    }
+    for locality_id in getParticipantIds(rules, "network_locality"):
+        source_locality_networks[locality_id] = networks.get(locality_id, [])
+    group_index = indexGroups(readSnapshotFile("target_device_groups"))
+    locality_index = indexLocalities(
+        readSnapshotFile("target_network_localities")
+    )
+    # Every lookup is answered from the snapshot, so no token is needed
+    updated_rules, unresolved = resolveRules(rules, None)
+    writeSnapshotFile("plan", updated_rules)
+    writeSnapshotFile("unresolved", unresolved)
+    logging.info(
+        f"Planned {len(updated_rules)} rules, {len(unresolved)} rules have "
+        f"unresolved participants"
+    )
+
+
+def migrate():
+    rules = getRules()
+    num_rules = str(len(rules))
+    logging.info(f"Migrating {num_rules} detection hiding rules")
+    token = getToken()
+    prefetchDevices(rules, token)
+    # Find equivalent IDs for participants
+    updated_rules, unresolved = resolveRules(rules, token)
+    not_found = [rule["rule_id"] for rule in unresolved]
     c = "y"
     # If unable to retrieve equivalent IDs for participants, warn user before
     # continuing
@@ -419,9 +1037,21 @@ def main():
         logging.warning(f"Do you want to migrate the other {total_up} rules?")
         c = input("(y/n)")
     if c == "y":
-        # Create new rules on target Reveal(x) 360 system
-        for rule in updated_rules:
-            success = makeRule(rule, token)
+        createRules(updated_rules, token)
+
+
+def main(mode=None):
+    if mode is None:
+        migrate()
+    elif mode == "snapshot":
+        takeSnapshot(getToken())
+    elif mode == "plan":
+        planMigration()
+    elif mode == "apply":
+        createRules(readSnapshotFile("plan"), getToken())
+    else:
+        logging.error(f"Unknown mode {mode}, expected snapshot, plan or apply")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -432,4 +1062,4 @@ if __name__ == "__main__":
         ],
         level=logging.INFO,
     )
-    main()
+    main(*sys.argv[1:2])
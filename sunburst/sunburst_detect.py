@@ -5,21 +5,73 @@
 
 #!/usr/bin/env python
 import argparse
+import base64
+import codecs
+import contextlib
 import datetime
+import email.utils
+import functools
 import csv
+import gzip
+import http.client
+import io
+import ipaddress
+import itertools
+import hashlib
 import json
 import logging
 import os
+import queue
+import random
+import re
 import socket
+import sqlite3
 import ssl
 import sys
+import threading
+import urllib.error
 import urllib.request
 import time
+import zlib
 
-from urllib.parse import urlencode
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from urllib.parse import unquote, urlencode, urlsplit
 
 DAY_MS = 86400000
 
+# Bounds (in seconds) for the wait between /metrics/next polls that return
+# "again"
+AGAIN_DELAY_MIN = 0.05
+AGAIN_DELAY_MAX = 2.0
+
+# Bounds for --adaptive query sizing: window sizes in milliseconds, OID
+# batch sizes in devices and the response size (bytes) to aim for
+ADAPTIVE_WINDOW_MIN = 60 * 60 * 1000
+ADAPTIVE_WINDOW_MAX = 14 * DAY_MS
+ADAPTIVE_BATCH_MAX = 2000
+ADAPTIVE_TARGET_PAYLOAD = 32 * 1024 * 1024
+
+# Number of devices to look up per /devices/search request
+DEVICE_SEARCH_BATCH_SIZE = 100
+
+# Number of rows per write when saving the --summary file
+SUMMARY_BATCH_SIZE = 1000
+
+# Minimum number of seconds between saves of the --summary file during a run
+SUMMARY_SAVE_INTERVAL = 60
+
+# Minimum number of seconds between --progress lines
+PROGRESS_INTERVAL = 10
+
+# HTTP statuses worth retrying: rate limiting and transient server errors.
+# Other error statuses (such as 404) fail the request right away.
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
 MALICIOUS_HOST_REGEX = (
     "/\\.(avsvmcloud|freescanonline|deftsecurity|thedoccloud|incomeupdate"
     "|zupertech|databasegalore|panhardware|websitetheme|highdatabase"
@@ -47,78 +99,1067 @@ def get_time_ms(tval):
 
 
 def get_query_intervals(from_time, until_time, interval_size):
-    next_until = from_time + interval_size - 1
     while from_time < until_time:
-        yield (from_time, next_until)
+        yield (from_time, min(from_time + interval_size - 1, until_time))
         from_time += interval_size
-        next_until = from_time + interval_size - 1
-        if next_until > until_time:
-            next_until = until_time
 
 
-def _api_request(args, path, body, method):
+class Telemetry:
+    """
+    Counters for the run report (see --report): requests, errors, retries,
+    bytes received and a latency histogram per API endpoint, "again" polls,
+    time spent in process functions, and work unit progress (see
+    --progress).
+    """
+
+    # Upper bounds in seconds of the latency histogram buckets
+    LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.endpoints = {}
+        self.again_polls = 0
+        self.process_seconds = 0.0
+        self.work_units = 0
+        self.show_progress = False
+        self.phase = None
+        self.last_progress = time.monotonic()
+
+    @staticmethod
+    def endpoint_name(path):
+        path = path.split("?")[0]
+        if path.startswith("/api/v1"):
+            path = path[len("/api/v1") :]
+        return re.sub(r"/\d+", "/{id}", path)
+
+    def _endpoint(self, path):
+        name = self.endpoint_name(path)
+        endpoint = self.endpoints.get(name)
+        if endpoint is None:
+            endpoint = self.endpoints[name] = {
+                "requests": 0,
+                "errors": {},
+                "retries": 0,
+                "bytes": 0,
+                "latency_seconds": dict.fromkeys(
+                    [str(b) for b in self.LATENCY_BUCKETS] + ["+Inf"], 0
+                ),
+                "latency_total_seconds": 0.0,
+                "latency_max_seconds": 0.0,
+            }
+        return endpoint
+
+    def record_response(self, path, status, latency, size):
+        bucket = next(
+            (str(b) for b in self.LATENCY_BUCKETS if latency <= b), "+Inf"
+        )
+        with self.lock:
+            endpoint = self._endpoint(path)
+            endpoint["requests"] += 1
+            endpoint["bytes"] += size
+            endpoint["latency_seconds"][bucket] += 1
+            endpoint["latency_total_seconds"] += latency
+            endpoint["latency_max_seconds"] = max(
+                endpoint["latency_max_seconds"], latency
+            )
+            if status >= 400:
+                errors = endpoint["errors"]
+                errors[str(status)] = errors.get(str(status), 0) + 1
+
+    def record_error(self, path, error):
+        with self.lock:
+            errors = self._endpoint(path)["errors"]
+            name = type(error).__name__
+            errors[name] = errors.get(name, 0) + 1
+
+    def record_retry(self, path):
+        with self.lock:
+            self._endpoint(path)["retries"] += 1
+
+    def record_again(self):
+        with self.lock:
+            self.again_polls += 1
+
+    def record_processing(self, seconds):
+        with self.lock:
+            self.process_seconds += seconds
+
+    def start_phase(self, name, size):
+        """
+        Starts tracking the progress of a phase of work units covering size
+        (time range times devices).
+        """
+        with self.lock:
+            self.phase = {
+                "name": name,
+                "size": max(size, 1),
+                "done": 0,
+                "units": 0,
+                "started": time.monotonic(),
+            }
+
+    def unit_done(self, size):
+        with self.lock:
+            self.work_units += 1
+            phase = self.phase
+            if not phase:
+                return
+            phase["done"] += size
+            phase["units"] += 1
+            now = time.monotonic()
+            if (
+                not self.show_progress
+                or now - self.last_progress < PROGRESS_INTERVAL
+            ):
+                return
+            self.last_progress = now
+            fraction = min(phase["done"] / phase["size"], 1)
+            elapsed = now - phase["started"]
+            eta = elapsed * (1 - fraction) / fraction if fraction else 0
+            received = sum(e["bytes"] for e in self.endpoints.values())
+        logging.info(
+            f"Progress: {phase['name']} {fraction:.0%} "
+            f"({phase['units']} queries, {received / 1e6:.1f} MB received), "
+            f"ETA {datetime.timedelta(seconds=int(eta))}"
+        )
+
+    def report(self, args):
+        with self.lock:
+            return {
+                "started": tstr(self.started * 1000),
+                "elapsed_seconds": round(time.time() - self.started, 3),
+                "options": {
+                    "cycle": args.cycle,
+                    "query_batch_size": args.query_batch_size,
+                    "oid_batch_size": args.oid_batch_size,
+                    "concurrency": args.concurrency,
+                    "eda_workers": args.eda_workers,
+                    "adaptive": args.adaptive,
+                },
+                "work_units": self.work_units,
+                "again_polls": self.again_polls,
+                "process_seconds": round(self.process_seconds, 3),
+                "endpoints": json.loads(json.dumps(self.endpoints)),
+            }
+
+    def save(self, args, path):
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.report(args), f, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+
+telemetry = Telemetry()
+
+
+class HttpPool:
+    """
+    Keeps idle keep-alive HTTPS connections per target so that consecutive
+    requests skip the TCP and TLS handshakes, and asks for gzip-compressed
+    responses. Connections go through the proxy in HTTPS_PROXY (as with
+    urllib) unless NO_PROXY excludes the target. Redirects are not followed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.proxy = urllib.request.getproxies().get("https")
+
+    def _acquire(self, host, timeout):
+        with self.lock:
+            connections = self.idle.get(host)
+            if connections:
+                return connections.pop(), True
+        return self._connect(host, timeout), False
+
+    def _connect(self, host, timeout):
+        context = ssl._create_default_https_context()
+        if not self.proxy or urllib.request.proxy_bypass(host):
+            return http.client.HTTPSConnection(
+                host, timeout=timeout, context=context
+            )
+        proxy = self.proxy if "://" in self.proxy else f"http://{self.proxy}"
+        proxy = urlsplit(proxy)
+        conn = http.client.HTTPSConnection(
+            proxy.hostname, proxy.port or 80, timeout=timeout, context=context
+        )
+        headers = {}
+        if proxy.username:
+            credentials = (
+                f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+            )
+            headers["Proxy-Authorization"] = "Basic " + base64.b64encode(
+                credentials.encode("utf-8")
+            ).decode("ascii")
+        conn.set_tunnel(host, headers=headers)
+        return conn
+
+    def _release(self, host, conn):
+        with self.lock:
+            self.idle.setdefault(host, []).append(conn)
+
+    def request(self, host, method, path, body, headers, timeout, stream=False):
+        """
+        Sends a request and returns the decompressed response body, raising
+        urllib.error.HTTPError for error statuses. With stream, a successful
+        response is returned as a ResponseStream instead.
+        """
+        headers = dict(headers, **{"Accept-Encoding": "gzip"})
+        while True:
+            started = time.monotonic()
+            conn, reused = self._acquire(host, timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                rsp = conn.getresponse()
+                if stream and rsp.status < 400:
+                    return ResponseStream(self, host, conn, rsp, path, started)
+                data = rsp.read()
+                break
+            except (
+                http.client.RemoteDisconnected,
+                ConnectionResetError,
+                BrokenPipeError,
+            ) as e:
+                conn.close()
+                # The server may close an idle connection at any time, so a
+                # failure on a reused connection is retried on a new one.
+                if not reused:
+                    telemetry.record_error(path, e)
+                    raise
+            except BaseException as e:
+                conn.close()
+                telemetry.record_error(path, e)
+                raise
+        telemetry.record_response(
+            path, rsp.status, time.monotonic() - started, len(data)
+        )
+        if rsp.will_close:
+            conn.close()
+        else:
+            self._release(host, conn)
+        if rsp.getheader("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        if rsp.status >= 400:
+            raise urllib.error.HTTPError(
+                f"https://{host}{path}",
+                rsp.status,
+                rsp.reason,
+                rsp.headers,
+                io.BytesIO(data),
+            )
+        return data
+
+
+class BodyReadError(Exception):
+    """
+    Reading the body of a streamed response failed. The error that caused it
+    (such as a timeout or a connection reset) is its __cause__.
+    """
+
+
+class BadResponse(ValueError):
+    """
+    The body of a streamed response is not valid UTF-8 JSON. data holds the
+    body from the undecodable part on.
+    """
+
+    def __init__(self, message, data):
+        super().__init__(message)
+        self.data = data
+
+
+class ResponseStream:
+    """
+    Body of a streamed response, iterated as decompressed chunks. The
+    connection goes back to the pool once the body has been read to the
+    end. A stream closed early is drained if at most DRAIN_SIZE bytes of the
+    body are left (such as the gzip trailer after the end of the JSON), so
+    that the connection can still be reused, and closed otherwise.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+    DRAIN_SIZE = 64 * 1024
+
+    def __init__(self, pool, host, conn, rsp, path, started):
+        self.pool = pool
+        self.host = host
+        self.conn = conn
+        self.rsp = rsp
+        self.path = path
+        # time spent sending the request and receiving the response, as
+        # opposed to processing it, for the endpoint latency
+        self.network_seconds = time.monotonic() - started
+        self.size = 0
+        self.done = False
+        self.decompressor = None
+        if rsp.getheader("Content-Encoding") == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def __iter__(self):
+        while True:
+            try:
+                chunk = self._read(self.CHUNK_SIZE)
+            except (OSError, http.client.HTTPException) as e:
+                telemetry.record_error(self.path, e)
+                self.conn.close()
+                self.conn = None
+                raise BodyReadError(str(e)) from e
+            if not chunk:
+                break
+            self.size += len(chunk)
+            if self.decompressor:
+                chunk = self.decompressor.decompress(chunk)
+            if chunk:
+                yield chunk
+        if self.decompressor:
+            chunk = self.decompressor.flush()
+            if chunk:
+                yield chunk
+        self.done = True
+        self.close()
+
+    def _read(self, size):
+        started = time.monotonic()
+        try:
+            return self.rsp.read(size)
+        finally:
+            self.network_seconds += time.monotonic() - started
+
+    def _drain(self):
+        left = self.DRAIN_SIZE
+        try:
+            while left >= 0:
+                chunk = self._read(min(self.CHUNK_SIZE, left + 1))
+                if not chunk:
+                    self.done = True
+                    return
+                self.size += len(chunk)
+                left -= len(chunk)
+        except (OSError, http.client.HTTPException):
+            pass
+
+    def close(self):
+        if self.conn is None:
+            return
+        if not self.done:
+            self._drain()
+        telemetry.record_response(
+            self.path,
+            self.rsp.status,
+            self.network_seconds,
+            self.size,
+        )
+        if self.done and not self.rsp.will_close:
+            self.pool._release(self.host, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+
+http_pool = HttpPool()
+
+
+class ByteCounter:
+    """
+    Count of the response bytes received for a work unit, added to by every
+    thread that reads one of its responses.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = 0
+
+    def add(self, size):
+        with self.lock:
+            self.total += size
+
+
+class StreamedMetrics:
+    """
+    Incrementally decoded JSON object, for large /metrics responses.
+
+    Top-level values that precede "stats" are decoded up front and available
+    through get(). The "stats" array itself is decoded one entry at a time
+    as it is iterated, so the response is never held in memory in full.
+    Values that follow "stats" become available once it has been iterated.
+    """
+
+    # Brackets and quotes, outside and inside of strings
+    SCAN_BRACKETS = re.compile(r'[][{}"]')
+    SCAN_STRING = re.compile(r'["\\]')
+    # Characters that may follow a number or literal
+    SCAN_SCALAR_END = re.compile(r"[\s,\]}]")
+
+    def __init__(self, stream, chunks, buf):
+        self.stream = stream
+        self.chunks = chunks
+        self.buf = buf
+        self.pos = 0
+        self.eof = False
+        self.close = stream.close
+        self.decoder = json.JSONDecoder()
+        self.header = {}
+        self.has_stats = False
+        self.stats_taken = False
+        # lowest oid seen in stats so far
+        self.min_oid = None
+        self._expect("{")
+        self._read_members()
+
+    def _next_chunk(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+        return chunk
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                raise self._bad_response("Truncated metrics response")
+            # The buffer has been consumed in full.
+            chunk = self._next_chunk()
+            if chunk is not None:
+                self.buf = chunk
+                self.pos = 0
+
+    def _expect(self, *chars):
+        c = self._peek()
+        if c not in chars:
+            raise self._bad_response(f"Unexpected {c!r} in metrics response")
+        self.pos += 1
+        return c
+
+    def _scan(self, text, i, state):
+        """
+        Scans text from i for the end of a value, given its scan state
+        (bracket depth, in a string, after a backslash). Returns whether the
+        value ends in text; otherwise updates state for the next text.
+        """
+        depth, in_string, escape = state
+        while True:
+            if escape:
+                if i >= len(text):
+                    break
+                i += 1
+                escape = False
+            if in_string:
+                match = self.SCAN_STRING.search(text, i)
+                if not match:
+                    break
+                i = match.end()
+                if match.group() == "\\":
+                    escape = True
+                    continue
+                in_string = False
+                if depth == 0:
+                    return True
+                continue
+            match = self.SCAN_BRACKETS.search(text, i)
+            if not match:
+                break
+            i = match.end()
+            c = match.group()
+            if c == '"':
+                in_string = True
+            elif c in "[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return True
+        state[:] = depth, in_string, escape
+        return False
+
+    def _read_value(self):
+        """
+        Reads chunks until the value at pos is complete in the buffer.
+
+        Only the text of each new chunk is scanned, and the chunks are joined
+        once the value is complete, so that a value split over many chunks is
+        read in linear time.
+        """
+        c = self.buf[self.pos]
+        state = [0, c == '"', False]
+        i = self.pos + 1 if c == '"' else self.pos
+        text = self.buf
+        parts = []
+        while True:
+            if c in '"[{':
+                complete = self._scan(text, i, state)
+            else:
+                complete = bool(self.SCAN_SCALAR_END.search(text, i))
+            if complete:
+                break
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            parts.append(chunk)
+            text = chunk
+            i = 0
+        if parts:
+            # Only the unconsumed text is kept.
+            self.buf = self.buf[self.pos :] + "".join(parts)
+            self.pos = 0
+
+    def _decode(self):
+        self._peek()
+        self._read_value()
+        try:
+            value, end = self.decoder.raw_decode(self.buf, self.pos)
+        except ValueError as e:
+            raise self._bad_response(str(e)) from e
+        self.pos = end
+        return value
+
+    def _bad_response(self, message):
+        return BadResponse(message, self.buf[self.pos :].encode("utf-8"))
+
+    def _read_members(self):
+        """
+        Decodes members into header until "stats" or the end of the object.
+        """
+        if self._peek() == "}":
+            self.pos += 1
+            self.close()
+            return
+        while True:
+            key = self._decode()
+            self._expect(":")
+            if key == "stats":
+                self._expect("[")
+                self.has_stats = True
+                return
+            self.header[key] = self._decode()
+            if self._expect(",", "}") == "}":
+                self.close()
+                return
+
+    def _iter_stats(self):
+        if self._peek() == "]":
+            self.pos += 1
+        else:
+            while True:
+                stat = self._decode()
+                if self.min_oid is None or stat["oid"] < self.min_oid:
+                    self.min_oid = stat["oid"]
+                yield stat
+                if self._expect(",", "]") == "]":
+                    break
+        if self._expect(",", "}") == "}":
+            self.close()
+        else:
+            self._read_members()
+
+    def get(self, key, default=None):
+        if key == "stats":
+            if not self.has_stats:
+                return default
+            if self.stats_taken:
+                raise RuntimeError("stats can only be iterated once")
+            self.stats_taken = True
+            return self._iter_stats()
+        return self.header.get(key, default)
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+
+def decode_chunks(stream):
+    """
+    Decodes the UTF-8 chunks of a ResponseStream, raising BadResponse for
+    invalid UTF-8.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in itertools.chain(stream, [b""]):
+        try:
+            yield decoder.decode(chunk, final=not chunk)
+        except UnicodeDecodeError as e:
+            raise BadResponse(str(e), chunk) from e
+
+
+def decode_json_stream(stream):
+    """
+    Decodes a ResponseStream. JSON objects are returned as StreamedMetrics;
+    anything else (such as "again") is decoded in full.
+    """
+    chunks = decode_chunks(stream)
+    buf = ""
+    for chunk in chunks:
+        buf += chunk
+        if buf.strip():
+            break
+    if buf.lstrip().startswith("{"):
+        return StreamedMetrics(stream, chunks, buf)
+    buf += "".join(chunks)
+    stream.close()
+    try:
+        return json.loads(buf)
+    except ValueError as e:
+        raise BadResponse(str(e), buf.encode("utf-8")) from e
+
+
+def save_bad_response(args, e, stream):
+    """
+    Writes the undecodable part of a streamed response, followed by the rest
+    of its body, to --bad-response-file.
+    """
+    logging.info("Error decoding API response: %s", e)
+    logging.info("Bad response in %s", args.bad_response_file)
+    with open(args.bad_response_file, "wb") as f:
+        f.write(e.data)
+        if stream.conn is not None:
+            try:
+                for chunk in stream:
+                    f.write(chunk)
+            except BodyReadError:
+                pass
+
+
+def _api_request(args, path, body, method, stream=False):
     if body:
         body = json.dumps(body).encode("utf-8")
-    req = urllib.request.Request(
-        f"https://{args.target}/api/v1{path}",
-        headers={
+    if not method:
+        method = "POST" if body else "GET"
+    rsp = http_pool.request(
+        args.target,
+        method,
+        f"/api/v1{path}",
+        body,
+        {
             "Accept": "application/json",
             "Authorization": f"ExtraHop apikey={args.api_key}",
             "Content-Type": "application/json",
         },
-        data=body,
+        args.request_timeout,
+        stream=stream,
     )
-    if method:
-        req.method = method
-    with urllib.request.urlopen(req, timeout=args.request_timeout) as rsp:
-        rsp_data = rsp.read()
+    if stream:
         try:
-            decoded_rsp_data = rsp_data.decode("utf-8")
-        except Exception as e:
-            logging.info("Error decoding API response: %s", e)
-            logging.info("Bad response in %s", args.bad_response_file)
-            with open(args.bad_response_file, "wb") as f:
-                f.write(rsp_data)
+            return decode_json_stream(rsp)
+        except BadResponse as e:
+            save_bad_response(args, e, rsp)
+            rsp.close()
             raise
-        return json.loads(decoded_rsp_data)
+    rsp_data = rsp
+    try:
+        decoded_rsp_data = rsp_data.decode("utf-8")
+    except Exception as e:
+        logging.info("Error decoding API response: %s", e)
+        logging.info("Bad response in %s", args.bad_response_file)
+        with open(args.bad_response_file, "wb") as f:
+            f.write(rsp_data)
+        raise
+    return json.loads(decoded_rsp_data)
 
 
-def api_request(args, path, body=None, method=None):
-    attempts = 5
-    timeout = 1
+def classify_error(e):
+    """
+    Returns "timeout", "transient" or "fatal" for an API request error.
+    """
+    if isinstance(e, socket.timeout):
+        return "timeout"
+    if isinstance(e, urllib.error.HTTPError):
+        return "transient" if e.code in RETRY_STATUSES else "fatal"
+    if isinstance(e, (ConnectionError, http.client.HTTPException)):
+        return "transient"
+    return "fatal"
+
+
+def retry_after_seconds(e):
+    """
+    Returns the delay requested by the Retry-After header of an HTTP error,
+    in seconds, or None.
+    """
+    value = e.headers.get("Retry-After") if e.headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+class CircuitBreaker:
+    """
+    Per-target circuit breaker shared by all threads. After
+    --breaker-threshold consecutive transient failures against a target, or
+    a Retry-After from it, the circuit opens and every request to that
+    target waits until it closes, so that concurrent queries back off
+    together instead of piling onto a struggling appliance. Each time the
+    circuit reopens before a request succeeds, it stays open twice as long.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.targets = {}
+
+    def _state(self, target, cooldown):
+        return self.targets.setdefault(
+            target, {"failures": 0, "open_until": 0, "cooldown": cooldown}
+        )
+
+    def wait(self, target):
+        while True:
+            with self.lock:
+                state = self.targets.get(target)
+                delay = state["open_until"] - time.monotonic() if state else 0
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def success(self, args):
+        with self.lock:
+            state = self.targets.get(args.target)
+            if state:
+                state["failures"] = 0
+                state["cooldown"] = args.breaker_cooldown
+
+    def failure(self, args, retry_after=None):
+        with self.lock:
+            state = self._state(args.target, args.breaker_cooldown)
+            now = time.monotonic()
+            if retry_after:
+                state["open_until"] = max(
+                    state["open_until"], now + retry_after
+                )
+            state["failures"] += 1
+            if state["failures"] < args.breaker_threshold:
+                return
+            logging.info(
+                f"{state['failures']} consecutive failures against "
+                f"{args.target}, pausing requests for {state['cooldown']} "
+                "seconds"
+            )
+            state["open_until"] = max(
+                state["open_until"], now + state["cooldown"]
+            )
+            state["cooldown"] = min(state["cooldown"] * 2, args.retry_max_delay)
+            state["failures"] = 0
+
+
+circuit_breaker = CircuitBreaker()
+
+
+def back_off(args, path, e, attempt, retry_timeouts=True):
+    """
+    Handles failed attempt number attempt of a request to path. Raises e
+    (or, for a BodyReadError, the error that caused it) if it is fatal, a
+    timeout that is not to be retried, or the last of --retries retries.
+    Otherwise feeds the target's circuit breaker and sleeps for a full-jitter
+    exponential backoff, honoring Retry-After.
+    """
+    if isinstance(e, BodyReadError):
+        e = e.__cause__
+    kind = classify_error(e)
+    if kind == "fatal":
+        raise e
+    retry_after = None
+    if isinstance(e, urllib.error.HTTPError):
+        retry_after = retry_after_seconds(e)
+        if retry_after is not None:
+            retry_after = min(retry_after, args.retry_max_delay)
+    circuit_breaker.failure(args, retry_after)
+    if kind == "timeout" and not retry_timeouts:
+        raise e
+    if attempt > args.retries:
+        raise e
+    telemetry.record_retry(path)
+    delay = random.uniform(
+        0, min(args.retry_max_delay, args.retry_base_delay * 2**attempt)
+    )
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    logging.info("%s, retrying in %.1f seconds", str(e), delay)
+    time.sleep(delay)
+
+
+def api_request(
+    args, path, body=None, method=None, retry_timeouts=True, stream=False
+):
+    """
+    Sends an API request. Transient errors (see classify_error) are retried
+    up to --retries times with full-jitter exponential backoff, honoring
+    Retry-After, and feed the target's circuit breaker. With stream, JSON
+    objects in the response are decoded incrementally and returned as
+    StreamedMetrics; the caller must iterate or close them. Errors while
+    reading the rest of their body are raised as BodyReadError (see
+    api_query).
+    """
+    attempt = 0
     while True:
+        circuit_breaker.wait(args.target)
         try:
-            return _api_request(args, path, body, method)
-        except (socket.timeout, urllib.error.HTTPError) as e:
-            attempts -= 1
-            if attempts == 0:
-                raise
-            timeout *= 2
-            logging.info("%s, retrying in %d seconds", str(e), timeout)
-            time.sleep(timeout)
+            rsp_data = _api_request(args, path, body, method, stream)
+        except Exception as e:
+            attempt += 1
+            back_off(args, path, e, attempt, retry_timeouts)
+            continue
+        circuit_breaker.success(args)
+        return rsp_data
+
+
+def api_query(args, path, w, query, retry_timeouts=True):
+    """
+    Runs query(buffer), which sends a streamed API request to path and
+    processes the response into buffer, and writes the buffered rows to w.
+    If reading the response body fails, the query is retried as a whole,
+    like api_request retries a request, since its rows are discarded.
+    """
+    attempt = 0
+    while True:
+        buffer = RowBuffer()
+        try:
+            found = query(buffer)
+            break
+        except BodyReadError as e:
+            attempt += 1
+            back_off(args, path, e, attempt, retry_timeouts)
+    for row in buffer.rows:
+        w.writerow(row)
+    return found
+
+
+class DeviceStore:
+    """
+    On-disk (SQLite) cache of devices and appliance ids, keyed by target, so
+    that repeated sweeps start warm.
+
+    Entries older than ttl seconds are ignored. Device rows are replaced when
+    a listing returns a different mod_time, and the oids returned by the last
+    active device listing are remembered so that the next sweep with the same
+    from time only needs to list devices active since then.
+    """
+
+    def __init__(self, path, target, ttl):
+        self.target = target
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS devices (
+                    target TEXT, oid INTEGER, mod_time INTEGER,
+                    fetched_at REAL, data TEXT,
+                    PRIMARY KEY (target, oid));
+                CREATE TABLE IF NOT EXISTS appliances (
+                    target TEXT, node_id INTEGER, appliance_id TEXT,
+                    fetched_at REAL,
+                    PRIMARY KEY (target, node_id));
+                CREATE TABLE IF NOT EXISTS listings (
+                    target TEXT, from_time INTEGER, until_time INTEGER,
+                    synced_at REAL,
+                    PRIMARY KEY (target, from_time));
+                CREATE TABLE IF NOT EXISTS listing_devices (
+                    target TEXT, from_time INTEGER, oid INTEGER,
+                    PRIMARY KEY (target, from_time, oid));
+                """
+            )
+
+    def _fresh_since(self):
+        return time.time() - self.ttl
+
+    def get_device(self, oid):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT data FROM devices"
+                " WHERE target = ? AND oid = ? AND fetched_at >= ?",
+                (self.target, oid, self._fresh_since()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_devices(self, devices):
+        """
+        Stores devices, returning how many of them were new or changed.
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            known = {}
+            for device in devices:
+                row = self.conn.execute(
+                    "SELECT mod_time FROM devices"
+                    " WHERE target = ? AND oid = ? AND fetched_at >= ?",
+                    (self.target, device["id"], self._fresh_since()),
+                ).fetchone()
+                if row:
+                    known[device["id"]] = row[0]
+            changed = []
+            unchanged = []
+            for device in devices:
+                oid = device["id"]
+                if oid in known and known[oid] == device.get("mod_time"):
+                    unchanged.append(device)
+                else:
+                    changed.append(device)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        self.target,
+                        device["id"],
+                        device.get("mod_time"),
+                        now,
+                        json.dumps(device),
+                    )
+                    for device in changed
+                ],
+            )
+            # Unchanged rows only need to stay fresh.
+            self.conn.executemany(
+                "UPDATE devices SET fetched_at = ? WHERE target = ? AND oid = ?",
+                [(now, self.target, device["id"]) for device in unchanged],
+            )
+        return len(changed)
+
+    def get_listing(self, from_time):
+        """
+        Returns (until_time, oids) for the last fresh active device listing
+        that started at from_time, or None.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT until_time FROM listings"
+                " WHERE target = ? AND from_time = ? AND synced_at >= ?",
+                (self.target, from_time, self._fresh_since()),
+            ).fetchone()
+            if not row:
+                return None
+            oids = [
+                oid
+                for (oid,) in self.conn.execute(
+                    "SELECT oid FROM listing_devices"
+                    " WHERE target = ? AND from_time = ? ORDER BY rowid",
+                    (self.target, from_time),
+                )
+            ]
+        return row[0], oids
+
+    def put_listing(self, from_time, until_time, oids):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM listing_devices WHERE target = ? AND from_time = ?",
+                (self.target, from_time),
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO listing_devices VALUES (?, ?, ?)",
+                [(self.target, from_time, oid) for oid in oids],
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+                (self.target, from_time, until_time, time.time()),
+            )
+
+    def get_appliance_id(self, node_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT appliance_id FROM appliances"
+                " WHERE target = ? AND node_id = ? AND fetched_at >= ?",
+                (self.target, node_id, self._fresh_since()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put_appliance_id(self, node_id, appliance_id):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO appliances VALUES (?, ?, ?, ?)",
+                (self.target, node_id, appliance_id, time.time()),
+            )
+
+    def close(self):
+        self.conn.close()
 
 
 device_cache = {}
 appliance_id_cache = {}
+# DeviceStore backing device_cache and appliance_id_cache (see --cache-file)
+device_store = None
 
 
-def get_device(args, oid):
+def cache_devices(devices):
     global device_cache
-    if oid in device_cache:
-        return device_cache[oid]
+    for device in devices:
+        device_cache[device["id"]] = device
+    if device_store:
+        return device_store.put_devices(devices)
+    return len(devices)
+
+
+def get_device(args, oid):
+    device = get_cached_device(oid)
+    if device:
+        return device
     try:
         device = api_request(args, f"/devices/{oid}")
-        device_cache[oid] = device
+        cache_devices([device])
         return device
     except urllib.error.HTTPError:
         return None
 
 
+def get_cached_device(oid):
+    if oid in device_cache:
+        return device_cache[oid]
+    if device_store:
+        device = device_store.get_device(oid)
+        if device:
+            device_cache[oid] = device
+            return device
+    return None
+
+
+def prefetch_devices(args, oids):
+    """
+    Looks up the uncached devices among oids with bulk /devices/search
+    requests (OR-ed id filters) instead of one /devices/{oid} request each.
+    Devices that the search does not return are left to get_device.
+    """
+    missing = [oid for oid in dict.fromkeys(oids) if not get_cached_device(oid)]
+    for i in range(0, len(missing), DEVICE_SEARCH_BATCH_SIZE):
+        batch = missing[i : i + DEVICE_SEARCH_BATCH_SIZE]
+        logging.info(f"Looking up {len(batch)} devices")
+        try:
+            devices = api_request(
+                args,
+                "/devices/search",
+                {
+                    "filter": {
+                        "operator": "or",
+                        "rules": [
+                            {
+                                "field": "id",
+                                "operand": str(oid),
+                                "operator": "=",
+                            }
+                            for oid in batch
+                        ],
+                    },
+                    "limit": len(batch),
+                },
+            )
+        except urllib.error.HTTPError as e:
+            logging.info(f"ERROR searching for devices {str(e)}")
+            return
+        wanted = set(batch)
+        cache_devices([device for device in devices if device["id"] in wanted])
+
+
 def process_application_host_stats(args, w, resp_data):
-    stats = resp_data.get("stats", [])
-    logging.info(f"Processing {len(stats)} stats")
     found = False
-    for stat in stats:
+    num_stats = 0
+    for stat in resp_data.get("stats", []):
+        num_stats += 1
         if not stat["values"][0]:
             continue
         oid = stat["oid"]
@@ -128,62 +1169,112 @@ def process_application_host_stats(args, w, resp_data):
             if not count:
                 continue
             found = True
-            w.writerow(
-                {
-                    "time": tstr(stat["time"]),
-                    "object_type": "application",
-                    "object_id": oid,
-                    "name": "All Activity",
-                    "indicator": host,
-                    "count": count,
-                    "uri": get_application_host_uri(
-                        args, oid, stat["time"], host
-                    ),
-                }
-            )
+            row = {
+                "time": tstr(stat["time"]),
+                "object_type": "application",
+                "object_id": oid,
+                "name": "All Activity",
+                "indicator": host,
+                "count": count,
+                "uri": get_application_host_uri(args, oid, stat["time"], host),
+            }
+            if host_campaigns:
+                row["campaigns"] = ";".join(host_campaigns.campaigns_for(host))
+            w.writerow(row)
+    logging.info(f"Processed {num_stats} stats")
     return found
 
 
-def get_all_active_devices(args):
-    logging.info(
-        "Getting all active devices between %s - %s",
-        tstr(args.from_time),
-        tstr(args.until_time),
-    )
-    global device_cache
+def list_active_devices(args, active_from, active_until):
+    """
+    Pages through the devices active between active_from and active_until,
+    keeping up to --list-workers pages in flight. Returns (oids, complete).
+    """
     LIMIT = 1000
     offset = 0
     oids = []
-    while True:
+    changed = 0
+
+    def fetch_page(page_offset):
+        body = {
+            "active_from": active_from,
+            "active_until": active_until,
+            "limit": LIMIT,
+            "offset": page_offset,
+        }
+        return api_request(args, f"/devices?{urlencode(body)}", method="GET")
+
+    # Pages ahead of offset are requested speculatively, assuming that every
+    # page is full; a short page resets the speculation to its end.
+    pages = {}
+    next_offset = 0
+    with ThreadPoolExecutor(max_workers=args.list_workers) as executor:
         try:
-            body = {
-                "active_from": args.from_time,
-                "active_until": args.until_time,
-                "limit": LIMIT,
-                "offset": offset,
-            }
-            devices = api_request(
-                args, f"/devices?{urlencode(body)}", method="GET"
-            )
-            if len(devices) == 0:
-                break
+            while True:
+                while len(pages) < args.list_workers:
+                    pages[next_offset] = executor.submit(
+                        fetch_page, next_offset
+                    )
+                    next_offset += LIMIT
+                try:
+                    devices = pages.pop(offset).result()
+                except urllib.error.HTTPError as e:
+                    logging.info(f"ERROR retrieving /devices {str(e)}")
+                    return oids, False
+                if len(devices) == 0:
+                    break
 
-            for device in devices:
-                oid = device["id"]
-                oids.append(oid)
-                device_cache[oid] = device
+                oids.extend(device["id"] for device in devices)
+                changed += cache_devices(devices)
 
-            logging.info(f"Requesting {offset}")
+                logging.info(f"Requesting {offset}")
 
-            offset += len(devices)
-        except urllib.error.HTTPError as e:
-            logging.info(f"ERROR retrieving /devices {str(e)}")
-            return oids
+                offset += len(devices)
+                if len(devices) < LIMIT:
+                    for future in pages.values():
+                        future.cancel()
+                    pages = {}
+                    next_offset = offset
+        finally:
+            for future in pages.values():
+                future.cancel()
+    if device_store:
+        logging.info(f"{changed} of {len(oids)} listed devices new or changed")
+    return oids, True
+
+
+def get_all_active_devices(args):
+    logging.info(
+        "Getting all active devices between %s - %s",
+        tstr(args.from_time),
+        tstr(args.until_time),
+    )
+    listing = device_store.get_listing(args.from_time) if device_store else None
+    if listing and listing[0] <= args.until_time:
+        # Devices active up to the cached listing's until time are already
+        # known, so only list the ones active since then.
+        listed_until, oids = listing
+        logging.info(
+            f"Using {len(oids)} cached devices active until "
+            f"{tstr(listed_until)}"
+        )
+        new_oids, complete = list_active_devices(
+            args, listed_until, args.until_time
+        )
+        known = set(oids)
+        oids.extend(oid for oid in new_oids if oid not in known)
+    else:
+        oids, complete = list_active_devices(
+            args, args.from_time, args.until_time
+        )
+    # Each --watch sweep starts where the previous one ended, so its listing
+    # would never be read again.
+    if device_store and complete and not args.watch:
+        device_store.put_listing(args.from_time, args.until_time, oids)
     return oids
 
 
 def get_device_oids_by_cidr(args):
-    global device_cache
     try:
         devices = api_request(
             args,
@@ -196,12 +1287,8 @@ def get_device_oids_by_cidr(args):
                 }
             },
         )
-        oids = []
-        for device in devices:
-            oid = device["id"]
-            oids.append(oid)
-            device_cache[oid] = device
-        return oids
+        cache_devices(devices)
+        return [device["id"] for device in devices]
     except urllib.error.HTTPError:
         return []
 
@@ -210,12 +1297,19 @@ def get_appliance_id(args, node_id):
     global appliance_id_cache
     if node_id in appliance_id_cache:
         return appliance_id_cache[node_id]
+    if device_store:
+        appliance_id = device_store.get_appliance_id(node_id)
+        if appliance_id:
+            appliance_id_cache[node_id] = appliance_id
+            return appliance_id
     try:
         appliance = api_request(args, f"/appliances/{node_id}")
     except urllib.error.HTTPError:
         return None
     appliance_id = appliance["uuid"].replace("-", "")
     appliance_id_cache[node_id] = appliance_id
+    if device_store:
+        device_store.put_appliance_id(node_id, appliance_id)
     return appliance_id
 
 
@@ -295,86 +1389,1305 @@ def get_application_host_uri(args, oid, time, host):
     )
 
 
-def process_device_net_detail_stats(args, w, resp):
+class IocMatcher:
+    """
+    Prefix tree of IOC networks with one level per address byte. Networks
+    whose prefix length is not a multiple of 8 are expanded into every value
+    of their last partial byte, so a lookup is at most 4 (IPv4) or 16 (IPv6)
+    dict lookups regardless of the number of indicators.
+    """
+
+    MATCH = -1
+
+    def __init__(self):
+        self.roots = {4: {}, 6: {}}
+
+    def add(self, network):
+        node = self.roots[network.version]
+        address = network.network_address.packed
+        full, partial = divmod(network.prefixlen, 8)
+        for byte in address[:full]:
+            node = node.setdefault(byte, {})
+        if partial:
+            first = address[full]
+            for byte in range(first, first + (1 << (8 - partial))):
+                node.setdefault(byte, {}).setdefault(self.MATCH, []).append(
+                    network
+                )
+        else:
+            node.setdefault(self.MATCH, []).append(network)
+
+    def match_all(self, addr):
+        """
+        Returns every IOC network containing addr, shortest prefix first.
+        """
+        try:
+            ip = ipaddress.ip_address(addr)
+        except ValueError:
+            return []
+        networks = []
+        node = self.roots[ip.version]
+        for byte in ip.packed:
+            networks += node.get(self.MATCH, [])
+            node = node.get(byte)
+            if node is None:
+                return networks
+        return networks + node.get(self.MATCH, [])
+
+    def match(self, addr):
+        """
+        Returns an IOC network containing addr, or None.
+        """
+        networks = self.match_all(addr)
+        return networks[0] if networks else None
+
+
+def hextet_regex(first, free):
+    """
+    Returns a regular expression that matches the hextets from first to
+    first + 2 ** free - 1 as written in IPv6 addresses: in lower case,
+    without leading zeros.
+    """
+    digits = []
+    for shift in (12, 8, 4, 0):
+        nibble = (first >> shift) & 0xF
+        nibble_free = min(max(free - shift, 0), 4)
+        if nibble_free == 4:
+            digits.append("[0-9a-f]")
+        elif nibble_free:
+            values = range(nibble, nibble + (1 << nibble_free))
+            digits.append("[" + "".join(f"{v:x}" for v in values) + "]")
+        else:
+            digits.append(f"{nibble:x}")
+    while len(digits) > 1 and digits[0] == "0":
+        digits.pop(0)
+    if digits[0].startswith("[0"):
+        # Leading zeros are dropped, so shorter hextets match too.
+        return f"[0-9a-f]{{1,{len(digits)}}}"
+    return "".join(digits)
+
+
+def ioc_regex(network):
+    """
+    Returns a regular expression (without delimiters) that matches every
+    address in network, as formatted in net_detail metric keys. For IPv6
+    networks the expression may also match other addresses; those are
+    filtered out by IocMatcher.
+    """
+    if network.version == 4:
+        octets = str(network.network_address).split(".")
+        full, partial = divmod(network.prefixlen, 8)
+        parts = octets[:full]
+        if partial:
+            first = int(octets[full])
+            values = range(first, first + (1 << (8 - partial)))
+            parts.append("(" + "|".join(str(v) for v in values) + ")")
+        parts += ["[0-9]+"] * (4 - len(parts))
+        return "\\.".join(parts)
+    if network.prefixlen == network.max_prefixlen:
+        return re.escape(network.network_address.compressed)
+    if network.prefixlen == 0:
+        return ".*:.*"
+    hextets = [int(h, 16) for h in network.network_address.exploded.split(":")]
+    full, partial = divmod(network.prefixlen, 16)
+    parts = []
+    for i in range(full + bool(partial)):
+        pattern = hextet_regex(hextets[i], 16 - partial if i == full else 0)
+        if hextets[i] == 0 and i < 7:
+            # A zero hextet may be compressed to "::" along with the ones
+            # that follow it, which are then unknown.
+            parts.append(f"({pattern})?")
+            break
+        parts.append(pattern)
+    if len(parts) == 8:
+        return ":".join(parts)
+    return ":".join(parts) + ":.*"
+
+
+class IocSet:
+    """
+    Compiled IOC list: key1 regular expressions of at most shard_size
+    characters each, and an IocMatcher to verify what they return.
+    Indicators may be labeled with the campaigns they belong to.
+
+    IPv6 networks whose first hextet is zero may be written starting with
+    "::", so their expressions match many other addresses; they are kept
+    in shards of their own so as not to widen the other shards.
+    """
+
+    OVERHEAD = len("/^()$/")
+
+    def __init__(self, shard_size):
+        self.shard_size = shard_size
+        self.matcher = IocMatcher()
+        # regex fragments, in insertion order
+        self.fragments = {}
+        self.broad_fragments = {}
+        # network -> names of the campaigns that list it
+        self.campaigns = {}
+
+    def add(self, indicators, campaign=None):
+        for indicator in indicators:
+            try:
+                network = ipaddress.ip_network(indicator.strip(), strict=False)
+            except ValueError:
+                logging.info(f"WARNING: ignoring invalid indicator {indicator}")
+                continue
+            if network not in self.campaigns:
+                self.matcher.add(network)
+                self.campaigns[network] = set()
+                fragment = ioc_regex(network)
+                if len(fragment) + self.OVERHEAD > self.shard_size:
+                    logging.info(
+                        f"WARNING: the regex of indicator {indicator} does "
+                        "not fit in --ioc-shard-size; it is queried on its own"
+                    )
+                if (
+                    network.version == 6
+                    and network.prefixlen < network.max_prefixlen
+                    and network.network_address.packed[:2] == b"\0\0"
+                ):
+                    self.broad_fragments[fragment] = None
+                else:
+                    self.fragments[fragment] = None
+            if campaign:
+                self.campaigns[network].add(campaign)
+
+    @property
+    def shards(self):
+        return self._pack(self.fragments) + self._pack(self.broad_fragments)
+
+    def _pack(self, fragments):
+        shards = []
+        shard = []
+        length = 0
+        for fragment in fragments:
+            if (
+                shard
+                and length + len(fragment) + 1 + self.OVERHEAD > self.shard_size
+            ):
+                shards.append("/^(" + "|".join(shard) + ")$/")
+                shard = []
+                length = 0
+            shard.append(fragment)
+            length += len(fragment) + 1
+        if shard:
+            shards.append("/^(" + "|".join(shard) + ")$/")
+        return shards
+
+    def campaigns_for(self, addr):
+        names = set()
+        for network in self.matcher.match_all(addr):
+            names |= self.campaigns[network]
+        return sorted(names)
+
+
+class HostCampaigns:
+    """
+    Host patterns of the campaigns in a --campaigns manifest. All patterns
+    are combined into a single key1 regular expression, and the hosts it
+    returns are tagged with the campaigns whose own patterns they match.
+    """
+
+    def __init__(self):
+        self.patterns = []
+
+    def add(self, pattern, campaign):
+        # Strip the /.../ delimiters of the ExtraHop regex syntax.
+        if (
+            len(pattern) > 1
+            and pattern.startswith("/")
+            and pattern.endswith("/")
+        ):
+            pattern = pattern[1:-1]
+        self.patterns.append((campaign, pattern, re.compile(pattern)))
+
+    def key1(self):
+        if not self.patterns:
+            return None
+        return "/" + "|".join(f"({p})" for _, p, _ in self.patterns) + "/"
+
+    def campaigns_for(self, host):
+        return sorted(
+            {name for name, _, regex in self.patterns if regex.search(host)}
+        )
+
+
+# HostCampaigns of the --campaigns manifest, if any
+host_campaigns = None
+
+
+def load_campaigns(path, shard_size):
+    """
+    Loads a --campaigns manifest: a JSON list of campaigns, each with a
+    "name" and any of "host_patterns" (a list of regular expressions),
+    "indicators" (a list of IPs and CIDR blocks) and "threat_list" (a JSON
+    file of IPs and CIDR blocks, relative to the manifest). Returns
+    (HostCampaigns, IocSet).
+    """
+    with open(path, "r") as f:
+        manifest = json.load(f)
+    hosts = HostCampaigns()
+    ioc_set = IocSet(shard_size)
+    for campaign in manifest:
+        name = campaign["name"]
+        for pattern in campaign.get("host_patterns", []):
+            hosts.add(pattern, name)
+        ioc_set.add(campaign.get("indicators", []), name)
+        if campaign.get("threat_list"):
+            threat_list = os.path.join(
+                os.path.dirname(path), campaign["threat_list"]
+            )
+            with open(threat_list, "r") as f:
+                ioc_set.add(json.load(f), name)
+    return hosts, ioc_set
+
+
+def net_detail_matches(stat, ioc_set=None):
+    """
+    Returns the net_detail entries of stat that are IOC matches.
+    """
+    return [
+        entry
+        for entry in stat["values"][0] or []
+        # the shard regex may be broader than the indicators it covers
+        if not ioc_set or ioc_set.matcher.match(entry["key"]["addr"])
+    ]
+
+
+def process_device_net_detail_stats(args, w, resp, ioc_set=None):
     found = False
-    # parse the stats
+    # Collect the matching stats first so that their devices can be looked
+    # up in bulk.
+    matches = []
     for stat in resp["stats"]:
-        if not stat["values"][0]:
-            continue
+        entries = net_detail_matches(stat, ioc_set)
+        if entries:
+            matches.append((stat, entries))
+    prefetch_devices(args, [stat["oid"] for stat, _ in matches])
+
+    for stat, entries in matches:
         oid = stat["oid"]
         device = get_device(args, oid)
         if not device:
             logging.info(f"Failed to look up matching device with id {oid}")
             continue
-        for entry in stat["values"][0]:
+        for entry in entries:
             found = True
             ipaddr = entry["key"]["addr"]
-            w.writerow(
+            row = {
+                "time": tstr(stat["time"]),
+                "object_type": "device",
+                "object_id": oid,
+                "name": device["display_name"],
+                "ipaddr": device["ipaddr4"] or device["ipaddr6"],
+                "macaddr": device["macaddr"],
+                "indicator": ipaddr,
+                "count": entry["value"],
+                "uri": get_device_ip_uri(args, oid, stat["time"], ipaddr),
+            }
+            if args.campaigns:
+                row["campaigns"] = ";".join(ioc_set.campaigns_for(ipaddr))
+            w.writerow(row)
+    return found
+
+
+class RowBuffer:
+    """
+    Collects the rows produced by a single work item so that they can be
+    handed to the writer in one piece.
+    """
+
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(row)
+
+
+class QueuedWriter:
+    """
+    Serializes rows coming from worker threads onto a csv.DictWriter from a
+    single writer thread.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            rows, on_written = item
+            for row in rows:
+                self.writer.writerow(row)
+            if on_written:
+                on_written()
+
+    def writerows(self, rows, on_written=None):
+        """
+        Queues rows for writing. on_written, if given, is called from the
+        writer thread once the rows have been written.
+        """
+        if rows or on_written:
+            self.queue.put((rows, on_written))
+
+    def writerow(self, row):
+        self.queue.put(([row], None))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class Checkpoint:
+    """
+    Journal (JSON lines) of completed work units. Each line holds the key of
+    a work unit and whether it found any indicators; with --resume, units
+    already in the journal are skipped.
+
+    Device metric units also record where they sit in their stream (time
+    window and OID index range), so that a resumed sweep can carve its work
+    along the same boundaries even when the sizes were chosen adaptively.
+    The journal also holds the bounds of the sweep and the devices it lists,
+    since the unit keys depend on both.
+
+    With a summary (a MatchSummary), completed units are journaled in
+    batches, each after the summary has been saved with their rows.
+    """
+
+    def __init__(self, path, output, resume, summary=None):
+        self.output = output
+        self.summary = summary
+        self.pending = []
+        self.synced = time.monotonic()
+        self.lock = threading.Lock()
+        self.done = {}
+        self.windows = {}
+        self.sweep = None
+        self.devices = None
+        if resume and os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a partially written last line
+                        continue
+                    if "sweep" in entry:
+                        self.sweep = entry["sweep"]
+                        continue
+                    if "devices" in entry:
+                        self.devices = entry["devices"]
+                        continue
+                    self.done[entry["key"]] = entry["found"]
+                    if entry.get("unit"):
+                        self._add_unit(entry["unit"])
+        self.file = open(path, "a" if resume else "w")
+
+    def start_sweep(self, args, until_given):
+        """
+        Records the bounds of a new sweep or, when resuming, restores the
+        until time of the interrupted one (which defaulted to the time it
+        started, unless until_given). Raises ValueError if the journal cannot
+        be resumed with these bounds.
+        """
+        if self.sweep:
+            if self.sweep["from"] != args.from_time or (
+                until_given and self.sweep["until"] != args.until_time
+            ):
+                raise ValueError(
+                    "the checkpoint journal is of the sweep "
+                    f"{tstr(self.sweep['from'])} - {tstr(self.sweep['until'])}"
+                )
+            args.until_time = self.sweep["until"]
+            return
+        if self.done:
+            raise ValueError(
+                "the checkpoint journal does not record the bounds of its sweep"
+            )
+        self.sweep = {"from": args.from_time, "until": args.until_time}
+        self._write({"sweep": self.sweep})
+
+    def record_devices(self, oids):
+        """
+        Records the devices listed for the sweep, which a resumed sweep
+        queries instead of listing them again.
+        """
+        self.devices = oids
+        self._write({"devices": oids})
+
+    def _write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def _add_unit(self, unit):
+        stream = self.windows.setdefault((unit["stream"], unit["oids"]), {})
+        window = stream.setdefault(
+            unit["from"], {"until": unit["until"], "batches": {}}
+        )
+        window["batches"][unit["first"]] = unit["last"]
+
+    def stream_windows(self, stream, oids_key):
+        """
+        Returns {from_time: {"until": until_time, "batches": {first: last}}}
+        for the journaled units of a stream.
+        """
+        return self.windows.get((stream, oids_key), {})
+
+    @staticmethod
+    def unit_key(*unit):
+        return hashlib.sha1(
+            json.dumps(unit, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def completed(self, key):
+        """
+        Returns the found flag of a completed unit, or None.
+        """
+        return self.done.get(key)
+
+    def record(self, key, found, unit=None):
+        entry = {"key": key, "found": found}
+        if unit:
+            entry["unit"] = unit
+        with self.lock:
+            self.done[key] = found
+            self.pending.append(entry)
+            if (
+                not self.summary
+                or time.monotonic() - self.synced >= SUMMARY_SAVE_INTERVAL
+            ):
+                self._sync()
+
+    def _sync(self):
+        # The rows of the pending units must be on disk before the units are
+        # journaled.
+        if self.output:
+            self.output.flush()
+        if self.summary:
+            self.summary.save()
+        self.file.write(
+            "".join(json.dumps(entry) + "\n" for entry in self.pending)
+        )
+        self.file.flush()
+        self.pending = []
+        self.synced = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self._sync()
+        self.file.close()
+
+
+class MatchSummary:
+    """
+    Per-(object, indicator) aggregates of the rows written to the output
+    file: first and last time seen, total count and number of time buckets.
+    Wraps the output writer, if any (see --summary-only), so that rows are
+    aggregated as they are written; only the aggregates are kept in memory.
+    The aggregates are saved to path by the checkpoint journal.
+    """
+
+    FIELDNAMES = [
+        "object_type",
+        "object_id",
+        "name",
+        "ipaddr",
+        "macaddr",
+        "indicator",
+        "first_seen",
+        "last_seen",
+        "count",
+        "buckets",
+    ]
+
+    def __init__(self, writer, path, campaigns=False):
+        self.writer = writer
+        self.path = path
+        self.fieldnames = self.FIELDNAMES + (["campaigns"] if campaigns else [])
+        self.aggregates = {}
+
+    def writerow(self, row):
+        if self.writer:
+            self.writer.writerow(row)
+        self.add(row)
+
+    def add(self, row):
+        object_id = int(row["object_id"])
+        key = (row["object_type"], object_id, row["indicator"])
+        aggregate = self.aggregates.get(key)
+        if aggregate is None:
+            aggregate = self.aggregates[key] = {
+                field: row.get(field) or "" for field in self.fieldnames
+            }
+            aggregate.update(
                 {
-                    "time": tstr(stat["time"]),
-                    "object_type": "device",
-                    "object_id": oid,
-                    "name": device["display_name"],
-                    "ipaddr": device["ipaddr4"] or device["ipaddr6"],
-                    "macaddr": device["macaddr"],
-                    "indicator": ipaddr,
-                    "count": entry["value"],
-                    "uri": get_device_ip_uri(args, oid, stat["time"], ipaddr),
+                    "object_id": object_id,
+                    "first_seen": row["time"],
+                    "last_seen": row["time"],
+                    "count": 0,
+                    "buckets": 0,
                 }
             )
-    return found
+        aggregate["first_seen"] = min(aggregate["first_seen"], row["time"])
+        aggregate["last_seen"] = max(aggregate["last_seen"], row["time"])
+        aggregate["count"] += int(row["count"])
+        aggregate["buckets"] += 1
+
+    def add_rows(self, path):
+        """
+        Aggregates the rows of an existing output file.
+        """
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                self.add(row)
+
+    def _open(self, path, mode):
+        if self.path.endswith(".gz"):
+            return gzip.open(path, mode, encoding="utf-8", newline="")
+        return open(path, mode, encoding="utf-8", newline="")
+
+    def load(self):
+        """
+        Loads the aggregates of an existing summary file.
+        """
+        name = (
+            self.path[: -len(".gz")] if self.path.endswith(".gz") else self.path
+        )
+        with self._open(self.path, "rt") as f:
+            if name.endswith(".jsonl"):
+                rows = (json.loads(line) for line in f)
+            else:
+                rows = csv.DictReader(f)
+            for row in rows:
+                aggregate = {
+                    field: row.get(field, "") for field in self.fieldnames
+                }
+                for field in ("object_id", "count", "buckets"):
+                    aggregate[field] = int(aggregate[field])
+                key = (
+                    aggregate["object_type"],
+                    aggregate["object_id"],
+                    aggregate["indicator"],
+                )
+                self.aggregates[key] = aggregate
+
+    def save(self):
+        """
+        Writes the aggregates to path as CSV, or as JSON lines if path ends
+        in .jsonl, compressed with gzip if path ends in .gz. The file is
+        replaced atomically.
+        """
+        path = self.path
+        name = path[: -len(".gz")] if path.endswith(".gz") else path
+        rows = sorted(
+            self.aggregates.values(),
+            key=lambda aggregate: (
+                aggregate["first_seen"],
+                aggregate["object_type"],
+                aggregate["object_id"],
+                aggregate["indicator"],
+            ),
+        )
+        with self._open(f"{path}.tmp", "wt") as f:
+            if name.endswith(".jsonl"):
+                for start in range(0, len(rows), SUMMARY_BATCH_SIZE):
+                    f.write(
+                        "".join(
+                            json.dumps(row) + "\n"
+                            for row in rows[start : start + SUMMARY_BATCH_SIZE]
+                        )
+                    )
+            else:
+                writer = csv.DictWriter(f, fieldnames=self.fieldnames)
+                writer.writeheader()
+                for start in range(0, len(rows), SUMMARY_BATCH_SIZE):
+                    writer.writerows(rows[start : start + SUMMARY_BATCH_SIZE])
+        os.replace(f"{path}.tmp", path)
+        logging.info(f"Wrote {len(rows)} summary rows to {path}")
+
+
+# Checkpoint journal of the current run (see --checkpoint-file)
+checkpoint = None
+
+
+def run_work_unit(key, description, fn):
+    """
+    Runs fn(w) for a work unit unless the checkpoint journal says it is
+    already complete. Returns (found, rows): the rows are buffered so that
+    they can be written and journaled together. A key of None is never
+    journaled.
+    """
+    if checkpoint and key:
+        found = checkpoint.completed(key)
+        if found is not None:
+            logging.info(f"Skipping completed work: {description}")
+            return found, []
+    logging.info(description)
+    buffer = RowBuffer()
+    return fn(buffer), buffer.rows
+
+
+def write_work_unit(w, key, found, rows, unit=None):
+    """
+    Writes the rows of a completed work unit and journals it. w is either a
+    csv.DictWriter or a QueuedWriter.
+    """
+    on_written = None
+    if checkpoint and key and checkpoint.completed(key) is None:
+        on_written = lambda: checkpoint.record(key, found, unit)
+    if isinstance(w, QueuedWriter):
+        w.writerows(rows, on_written)
+        return
+    for row in rows:
+        w.writerow(row)
+    if on_written:
+        on_written()
+
+
+class AdaptiveSizer:
+    """
+    Chooses the query window and OID batch size for the next work unit from
+    the latency and payload size of completed units (see --adaptive).
+
+    Units that finish well under the target latency and payload grow the
+    sizes, slower or larger ones shrink them, and a timeout halves both.
+    """
+
+    def __init__(self, args):
+        self.lock = threading.Lock()
+        self.window = args.query_batch_size
+        self.batch = args.oid_batch_size
+        self.target_latency = args.adaptive_target_latency
+        self.target_payload = ADAPTIVE_TARGET_PAYLOAD
+
+    def sizes(self):
+        with self.lock:
+            return self._rounded()
+
+    def _rounded(self):
+        # The sizes are kept as floats so that repeated small growth factors
+        # add up instead of being rounded away.
+        return int(round(self.window)), int(round(self.batch))
+
+    def _scale(self, factor):
+        # Spread the change over both dimensions.
+        factor = factor**0.5
+        self.window = min(
+            max(self.window * factor, ADAPTIVE_WINDOW_MIN), ADAPTIVE_WINDOW_MAX
+        )
+        self.batch = min(max(self.batch * factor, 1), ADAPTIVE_BATCH_MAX)
+
+    def observe(self, latency, payload):
+        factor = min(
+            self.target_latency / max(latency, 0.001),
+            self.target_payload / max(payload, 1),
+        )
+        if 0.75 <= factor <= 1.5:
+            return
+        with self.lock:
+            before = self._rounded()
+            self._scale(min(max(factor, 0.5), 2))
+            window, batch = self._rounded()
+            if (window, batch) != before:
+                logging.info(
+                    f"Adjusted query size to {window // 60000} minutes and "
+                    f"{batch} devices"
+                )
+
+    def timed_out(self):
+        with self.lock:
+            self._scale(0.25)
+
+
+def query_device_metrics(
+    args,
+    w,
+    category,
+    specs,
+    from_time,
+    until_time,
+    device_batch,
+    process_fn,
+    retry_timeouts=True,
+    received=None,
+):
+    """
+    Queries category metrics for device_batch. With --sensor-config, the
+    devices of configured sensors are queried on those sensors directly (in
+    parallel), and only the rest go through the target. The size of the
+    responses is added to received (a ByteCounter), if any.
+    """
+    routes = {}
+    for oid in device_batch:
+        node_id = oid >> 32 if (oid >> 32) in args.sensors else None
+        routes.setdefault(node_id, []).append(oid)
+    if None in routes and len(routes) == 1:
+        return query_metrics_route(
+            args,
+            w,
+            None,
+            category,
+            specs,
+            from_time,
+            until_time,
+            device_batch,
+            process_fn,
+            retry_timeouts,
+            received,
+        )
 
+    def query_route(node_id):
+        buffer = RowBuffer()
+        found = query_metrics_route(
+            args,
+            buffer,
+            node_id,
+            category,
+            specs,
+            from_time,
+            until_time,
+            routes[node_id],
+            process_fn,
+            retry_timeouts,
+            received,
+        )
+        return found, buffer.rows
 
-def show_device_metrics(args, w, category, specs, oids, process_fn):
+    order = sorted(routes, key=lambda node_id: min(routes[node_id]))
+    with ThreadPoolExecutor(max_workers=len(order)) as executor:
+        results = list(executor.map(query_route, order))
     found = False
+    for route_found, rows in results:
+        for row in rows:
+            w.writerow(row)
+        found |= route_found
+    return found
 
-    for from_time, until_time in get_query_intervals(
-        args.from_time, args.until_time, args.query_batch_size
-    ):
-        for i in range(0, len(oids), args.oid_batch_size):
-            device_batch = oids[i : i + args.oid_batch_size]
-            logging.info(
-                "Getting %s metrics from %s - %s for %d-%d of %d devices",
+
+def process_sensor_metrics(console_args, node_id, process_fn, args, w, resp):
+    # A sensor reports its own node-local oids, and the rows still link to
+    # the target.
+    stats = (
+        dict(stat, oid=(node_id << 32) | (stat["oid"] & 0xFFFFFFFF))
+        for stat in resp["stats"]
+    )
+    return process_fn(console_args, w, {"stats": stats})
+
+
+def query_metrics_route(
+    args,
+    w,
+    node_id,
+    category,
+    specs,
+    from_time,
+    until_time,
+    device_batch,
+    process_fn,
+    retry_timeouts,
+    received=None,
+):
+    """
+    Sends a device metrics query to the sensor with node_id, or to the
+    target if node_id is None.
+    """
+    route_args = args
+    if node_id is not None:
+        sensor = args.sensors[node_id]
+        route_args = argparse.Namespace(**vars(args))
+        route_args.target = sensor["target"]
+        route_args.api_key = sensor.get("api_key", args.api_key)
+        device_batch = [oid & 0xFFFFFFFF for oid in device_batch]
+        process_fn = functools.partial(
+            process_sensor_metrics, args, node_id, process_fn
+        )
+    body = {
+        "cycle": args.cycle,
+        "from": from_time,
+        "until": until_time,
+        "metric_category": category,
+        "object_type": "device",
+        "metric_specs": specs,
+        "object_ids": device_batch,
+    }
+
+    def query(buffer):
+        resp = api_request(
+            route_args,
+            "/metrics",
+            body=body,
+            retry_timeouts=retry_timeouts,
+            stream=True,
+        )
+        return for_each_eda(
+            route_args, buffer, resp, process_fn, retry_timeouts, received
+        )
+
+    return api_query(route_args, "/metrics", w, query, retry_timeouts)
+
+
+def load_sensor_config(path):
+    """
+    Loads a --sensor-config file: a JSON object mapping node ids (the upper
+    32 bits of device oids) to {"target": host, "api_key": key}. Returns
+    {node_id: sensor}.
+    """
+    with open(path, "r") as f:
+        config = json.load(f)
+    sensors = {}
+    for node_id, sensor in config.items():
+        if not sensor.get("target"):
+            raise ValueError(f"no target for node {node_id}")
+        sensors[int(node_id)] = sensor
+    return sensors
+
+
+def query_device_metrics_adaptive(
+    args,
+    w,
+    sizer,
+    category,
+    specs,
+    from_time,
+    until_time,
+    device_batch,
+    process_fn,
+):
+    """
+    Like query_device_metrics, but a query that times out is split in two
+    (by devices, or by time for a single device) instead of being retried
+    at the same size. Latency and payload size are reported to sizer.
+    """
+    started = time.monotonic()
+    received = ByteCounter()
+    buffer = RowBuffer()
+    try:
+        found = query_device_metrics(
+            args,
+            buffer,
+            category,
+            specs,
+            from_time,
+            until_time,
+            device_batch,
+            process_fn,
+            retry_timeouts=False,
+            received=received,
+        )
+    except socket.timeout:
+        sizer.timed_out()
+        if len(device_batch) > 1:
+            middle = len(device_batch) // 2
+            halves = [
+                (from_time, until_time, device_batch[:middle]),
+                (from_time, until_time, device_batch[middle:]),
+            ]
+        elif until_time - from_time >= 2 * ADAPTIVE_WINDOW_MIN:
+            middle = from_time + (until_time - from_time) // 2
+            halves = [
+                (from_time, middle, device_batch),
+                (middle + 1, until_time, device_batch),
+            ]
+        else:
+            # too small to split, fall back to plain retries
+            return query_device_metrics(
+                args,
+                w,
+                category,
+                specs,
+                from_time,
+                until_time,
+                device_batch,
+                process_fn,
+            )
+        logging.info(
+            f"{category} query for {len(device_batch)} devices from "
+            f"{tstr(from_time)} - {tstr(until_time)} timed out, splitting it"
+        )
+        found = False
+        for half in halves:
+            found |= query_device_metrics_adaptive(
+                args, w, sizer, category, specs, *half, process_fn
+            )
+        return found
+    sizer.observe(time.monotonic() - started, received.total)
+    for row in buffer.rows:
+        w.writerow(row)
+    return found
+
+
+def carve_work_units(args, oids, stream, sizer):
+    """
+    Yields (from_time, until_time, first, last) work units covering the
+    sweep: time windows, each split into oids[first:last] batches. Sizes
+    are read from sizer (if any) as units are carved, and windows and
+    batches already in the checkpoint journal are reproduced exactly.
+    """
+    journaled = (
+        checkpoint.stream_windows(stream, Checkpoint.unit_key(oids))
+        if checkpoint and stream
+        else {}
+    )
+    from_time = args.from_time
+    while from_time < args.until_time:
+        window_size, batch_size = (
+            sizer.sizes()
+            if sizer
+            else (args.query_batch_size, args.oid_batch_size)
+        )
+        window = journaled.get(from_time)
+        if window and window["until"] <= args.until_time:
+            until_time = window["until"]
+            batches = window["batches"]
+        else:
+            until_time = min(from_time + window_size - 1, args.until_time)
+            batches = {}
+        first = 0
+        while first < len(oids):
+            if first in batches:
+                last = batches[first]
+            else:
+                if sizer:
+                    batch_size = sizer.sizes()[1]
+                last = min(
+                    [first + batch_size, len(oids)]
+                    + [start for start in batches if start > first]
+                )
+            yield from_time, until_time, first, last
+            first = last
+        from_time = until_time + 1
+
+
+def device_queries(category, spec_shards, process_fn):
+    """
+    Returns one (category, specs, process_fn, label) device query per entry
+    of spec_shards (a list of metric_specs lists).
+    """
+    queries = []
+    for index, specs in enumerate(spec_shards):
+        label = ""
+        if len(spec_shards) > 1:
+            label = f" (indicator shard {index + 1}/{len(spec_shards)})"
+        queries.append((category, specs, process_fn, label))
+    return queries
+
+
+def show_device_metrics(
+    args, w, category, spec_shards, oids, process_fn, units=None, journal=True
+):
+    """
+    Queries category metrics for oids, one work unit per time window, OID
+    batch and entry of spec_shards (a list of metric_specs lists).
+
+    units, if given, replaces the regular carving with explicit
+    (spec_shards index, (from_time, until_time, first, last)) work units.
+    With journal=False the work units bypass the checkpoint journal.
+    """
+    queries = device_queries(category, spec_shards, process_fn)
+    return any(
+        run_device_queries(args, w, queries, oids, units=units, journal=journal)
+    )
+
+
+def show_pipelined_device_metrics(args, w, searches, oids):
+    """
+    Runs several device searches (category, spec_shards, process_fn, ...)
+    over the same time windows and OID batches: each batch is queried for
+    every search before moving on to the next one, so the device list is
+    walked once. Returns whether each search found anything.
+    """
+    queries = []
+    for category, spec_shards, process_fn, *_ in searches:
+        queries += device_queries(category, spec_shards, process_fn)
+    found = run_device_queries(args, w, queries, oids, pipeline=True)
+    results = []
+    for category, *_ in searches:
+        results.append(
+            any(
+                query_found
+                for query, query_found in zip(queries, found)
+                if query[0] == category
+            )
+        )
+    return results
+
+
+def run_device_queries(
+    args, w, queries, oids, units=None, journal=True, pipeline=False
+):
+    """
+    Runs device queries (see device_queries) for oids, one work unit per
+    query, time window and OID batch. Returns whether each query found
+    anything.
+
+    Without pipeline, each query sweeps all windows and batches in turn.
+    With pipeline, every query is run on a batch before the next batch, and
+    the batches are carved (and journaled) as a single stream. units, if
+    given, replaces the regular carving with explicit (query index,
+    (from_time, until_time, first, last)) work units. With journal=False the
+    work units bypass the checkpoint journal.
+    """
+    found = [False] * len(queries)
+    sizer = AdaptiveSizer(args) if args.adaptive else None
+    oids_key = Checkpoint.unit_key(oids)
+
+    if units:
+        size = sum(
+            (until_time - from_time + 1) * (last - first)
+            for _, (from_time, until_time, first, last) in units
+        )
+    else:
+        size = len(queries) * (args.until_time - args.from_time + 1) * len(oids)
+    telemetry.start_phase(
+        "/".join(dict.fromkeys(query[0] for query in queries)), size
+    )
+
+    def stream_key(stream_queries):
+        if not journal:
+            return None
+        if len(stream_queries) == 1:
+            category, specs = stream_queries[0][:2]
+            return Checkpoint.unit_key(category, specs)
+        return Checkpoint.unit_key([query[:2] for query in stream_queries])
+
+    if units:
+        work_units = ((index, unit, None) for index, unit in units)
+    elif pipeline:
+        stream = stream_key(queries)
+        work_units = (
+            (index, unit, stream)
+            for unit in carve_work_units(args, oids, stream, sizer)
+            for index in range(len(queries))
+        )
+    else:
+        work_units = (
+            (index, unit, stream_key([query]))
+            for index, query in enumerate(queries)
+            for unit in carve_work_units(args, oids, stream_key([query]), sizer)
+        )
+
+    def run_work_item(index, unit, stream):
+        category, specs, process_fn, label = queries[index]
+        from_time, until_time, first, last = unit
+        device_batch = oids[first:last]
+        key = None
+        if journal:
+            key = Checkpoint.unit_key(
+                category, specs, from_time, until_time, sorted(device_batch)
+            )
+        if units:
+            description = (
+                f"Getting {category} metrics from {tstr(from_time)} - "
+                f"{tstr(until_time)} for {last - first} devices"
+            )
+        else:
+            description = (
+                f"Getting {category} metrics from {tstr(from_time)} - "
+                f"{tstr(until_time)} for {first + 1}-{last} of "
+                f"{len(oids)} devices"
+            )
+        description += label
+        if sizer:
+            query = lambda buffer: query_device_metrics_adaptive(
+                args,
+                buffer,
+                sizer,
                 category,
-                tstr(from_time),
-                tstr(until_time),
-                i + 1,
-                i + len(device_batch),
-                len(oids),
+                specs,
+                from_time,
+                until_time,
+                device_batch,
+                process_fn,
             )
-            resp = api_request(
+        else:
+            query = lambda buffer: query_device_metrics(
                 args,
-                "/metrics",
-                body={
-                    "cycle": args.cycle,
-                    "from": from_time,
-                    "until": until_time,
-                    "metric_category": category,
-                    "object_type": "device",
-                    "metric_specs": specs,
-                    "object_ids": device_batch,
-                },
+                buffer,
+                category,
+                specs,
+                from_time,
+                until_time,
+                device_batch,
+                process_fn,
             )
-            found |= for_each_eda(args, w, resp, process_fn)
+        item_found, rows = run_work_unit(key, description, query)
+        telemetry.unit_done((until_time - from_time + 1) * (last - first))
+        journal_unit = None
+        if stream:
+            journal_unit = {
+                "stream": stream,
+                "oids": oids_key,
+                "from": from_time,
+                "until": until_time,
+                "first": first,
+                "last": last,
+            }
+        return key, item_found, rows, journal_unit
+
+    if args.concurrency <= 1:
+        for work_unit in work_units:
+            key, item_found, rows, journal_unit = run_work_item(*work_unit)
+            write_work_unit(w, key, item_found, rows, journal_unit)
+            found[work_unit[0]] |= item_found
+        return found
+
+    # Each work item buffers its own rows; the rows are handed to a single
+    # writer thread once the work item completes. Units are carved lazily,
+    # at most --concurrency at a time, so that adaptive sizes take effect.
+    writer = QueuedWriter(w)
+
+    def run_buffered_work_item(index, *work_unit):
+        key, item_found, rows, journal_unit = run_work_item(index, *work_unit)
+        write_work_unit(writer, key, item_found, rows, journal_unit)
+        return index, item_found
+
+    def collect(future):
+        index, item_found = future.result()
+        found[index] |= item_found
+
+    pending = set()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            try:
+                for work_unit in work_units:
+                    if len(pending) >= args.concurrency:
+                        done, pending = wait(
+                            pending, return_when=FIRST_COMPLETED
+                        )
+                        for future in done:
+                            collect(future)
+                    pending.add(
+                        executor.submit(run_buffered_work_item, *work_unit)
+                    )
+                for future in as_completed(pending):
+                    collect(future)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+    finally:
+        writer.close()
 
     return found
 
 
-def show_device_ip_metrics(args, w, ti_ips, oids):
+def find_coarse_hits(args, category, spec_shards, oids, hit_fn):
+    """
+    First phase of a --coarse-cycle search: queries category metrics at the
+    coarse cycle and returns {(specs index, from_time, until_time): oids}
+    for the metric buckets in which hit_fn(stat) is true. The queries are
+    cheap, so they are not journaled and are repeated on --resume.
+    """
+    coarse_args = argparse.Namespace(**vars(args))
+    coarse_args.cycle = args.coarse_cycle
+    hits = {}
+    lock = threading.Lock()
+
+    def collect_hits(index, args, w, resp):
+        found = False
+        for stat in resp["stats"]:
+            if not hit_fn(stat):
+                continue
+            found = True
+            bucket = (
+                index,
+                max(stat["time"], args.from_time),
+                min(stat["time"] + stat["duration"] - 1, args.until_time),
+            )
+            with lock:
+                hits.setdefault(bucket, set()).add(stat["oid"])
+        return found
+
+    for index, specs in enumerate(spec_shards):
+        show_device_metrics(
+            coarse_args,
+            RowBuffer(),
+            category,
+            [specs],
+            oids,
+            functools.partial(collect_hits, index),
+            journal=False,
+        )
+    return hits
+
+
+def search_device_metrics(
+    args, w, category, spec_shards, oids, process_fn, hit_fn
+):
+    """
+    Queries category metrics for oids. With --coarse-cycle, the range is
+    first scanned at the coarse cycle, and only the devices and buckets with
+    hits (according to hit_fn) are queried again at --cycle for precise
+    timestamps.
+    """
+    if not args.coarse_cycle:
+        return show_device_metrics(
+            args, w, category, spec_shards, oids, process_fn
+        )
+
+    logging.info(f"Scanning {category} metrics at {args.coarse_cycle} cycle")
+    hits = find_coarse_hits(args, category, spec_shards, oids, hit_fn)
+    if not hits:
+        return False
+    logging.info(
+        f"Found {category} hits in {len(hits)} {args.coarse_cycle} buckets, "
+        f"refining them at {args.cycle} cycle"
+    )
+
+    # Queue a work unit per bucket and OID batch; the batches are laid out
+    # one after the other in hit_oids.
+    units = []
+    hit_oids = []
+    for (index, from_time, until_time), bucket_oids in sorted(
+        hits.items(), key=lambda hit: (hit[0][1], hit[0][0])
+    ):
+        bucket_oids = sorted(bucket_oids)
+        for start in range(0, len(bucket_oids), args.oid_batch_size):
+            batch = bucket_oids[start : start + args.oid_batch_size]
+            units.append(
+                (
+                    index,
+                    (
+                        from_time,
+                        until_time,
+                        len(hit_oids),
+                        len(hit_oids) + len(batch),
+                    ),
+                )
+            )
+            hit_oids += batch
+    return show_device_metrics(
+        args, w, category, spec_shards, hit_oids, process_fn, units=units
+    )
+
+
+def device_ip_search(ioc_set):
+    """
+    Returns the category, metric_specs shards, process function and hit
+    filter of the device IP search.
+    """
+    return (
+        "net_detail",
+        [[{"name": "bytes_out", "key1": key1}] for key1 in ioc_set.shards],
+        functools.partial(process_device_net_detail_stats, ioc_set=ioc_set),
+        lambda stat: bool(net_detail_matches(stat, ioc_set)),
+    )
+
+
+def show_device_ip_metrics(args, w, ioc_set, oids):
     """
     Searches the target for suspicious activity by device ip metrics
     """
-    ip_regexp = "/^(" + "|".join(ti_ips) + ")$/"
-    ip_regexp = ip_regexp.replace(".", "\\.")
-    metric_specs = [{"name": "bytes_out", "key1": ip_regexp}]
-
-    return show_device_metrics(
-        args,
-        w,
-        "net_detail",
-        metric_specs,
-        oids,
-        process_device_net_detail_stats,
+    category, spec_shards, process_fn, hit_fn = device_ip_search(ioc_set)
+    return search_device_metrics(
+        args, w, category, spec_shards, oids, process_fn, hit_fn
     )
 
 
@@ -392,81 +2705,248 @@ def show_application_host_metrics(args, w):
         logging.info("WARNING: failed to retrieve default applications")
         return
 
-    body = {
-        "cycle": args.cycle,
-        "from": args.from_time,
-        "until": args.until_time,
-        "metric_category": "dns_host_query_detail",
-        "metric_specs": [{"name": "req", "key1": f"{args.host_regex}"}],
-        "object_type": "application",
-        "object_ids": oids,
-    }
-    resp_data = api_request(args, "/metrics", body=body)
+    # Query one --query-batch-size interval per work unit, like the device
+    # metrics, so that long ranges do not run into --request-timeout.
+    def run_interval(interval):
+        from_time, until_time = interval
+        body = {
+            "cycle": args.cycle,
+            "from": from_time,
+            "until": until_time,
+            "metric_category": "dns_host_query_detail",
+            "metric_specs": [{"name": "req", "key1": f"{args.host_regex}"}],
+            "object_type": "application",
+            "object_ids": oids,
+        }
+        key = Checkpoint.unit_key(body)
+
+        def query_edas(buffer):
+            resp_data = api_request(args, "/metrics", body=body, stream=True)
+            return for_each_eda(
+                args, buffer, resp_data, process_application_host_stats
+            )
+
+        def query(buffer):
+            return api_query(args, "/metrics", buffer, query_edas)
+
+        description = (
+            f"Querying application host metrics from {tstr(from_time)} - "
+            f"{tstr(until_time)}"
+        )
+        result = run_work_unit(key, description, query)
+        telemetry.unit_done(until_time - from_time + 1)
+        return (key, *result)
 
-    found = for_each_eda(args, w, resp_data, process_application_host_stats)
+    intervals = get_query_intervals(
+        args.from_time, args.until_time, args.query_batch_size
+    )
+    telemetry.start_phase(
+        "dns_host_query_detail", args.until_time - args.from_time + 1
+    )
+    # Results are written in interval order as they complete.
+    with ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as executor:
+        for key, interval_found, rows in executor.map(run_interval, intervals):
+            write_work_unit(w, key, interval_found, rows)
+            found |= interval_found
     return found
 
 
 def process_device_dns_host_stats(args, w, resp):
     found = False
-    for stat in resp["stats"]:
-        if stat["values"][0]:
-            found = True
-            time = stat["time"]
-            oid = stat["oid"]
-            device = get_device(args, oid)
-            if not device:
-                logging.info(f"Failed to look up matching device with id {oid}")
-                continue
-            for entry in stat["values"][0]:
-                host = entry["key"]["str"]
-                count = entry["value"]
-                w.writerow(
-                    {
-                        "time": tstr(time),
-                        "object_type": "device",
-                        "object_id": oid,
-                        "name": device["display_name"],
-                        "ipaddr": device["ipaddr4"] or device["ipaddr6"],
-                        "macaddr": device["macaddr"],
-                        "indicator": host,
-                        "count": count,
-                    }
-                )
+    # Collect the matching stats first so that their devices can be looked
+    # up in bulk.
+    matches = [stat for stat in resp["stats"] if stat["values"][0]]
+    prefetch_devices(args, [stat["oid"] for stat in matches])
+    for stat in matches:
+        found = True
+        time = stat["time"]
+        oid = stat["oid"]
+        device = get_device(args, oid)
+        if not device:
+            logging.info(f"Failed to look up matching device with id {oid}")
+            continue
+        for entry in stat["values"][0]:
+            host = entry["key"]["str"]
+            count = entry["value"]
+            row = {
+                "time": tstr(time),
+                "object_type": "device",
+                "object_id": oid,
+                "name": device["display_name"],
+                "ipaddr": device["ipaddr4"] or device["ipaddr6"],
+                "macaddr": device["macaddr"],
+                "indicator": host,
+                "count": count,
+            }
+            if host_campaigns:
+                row["campaigns"] = ";".join(host_campaigns.campaigns_for(host))
+            w.writerow(row)
     return found
 
 
-def for_each_eda(args, w, first_metrics_resp, process_fn):
+def poll_eda_result(args, xid, retry_timeouts=True):
+    """
+    Polls /metrics/next/{xid} until the ECA has the next EDA result ready,
+    backing off exponentially while the ECA keeps answering "again".
+    """
+    delay = AGAIN_DELAY_MIN
+    while True:
+        resp_data = api_request(
+            args,
+            f"/metrics/next/{xid}",
+            method="GET",
+            retry_timeouts=retry_timeouts,
+            stream=True,
+        )
+        if resp_data != "again":
+            return resp_data
+        telemetry.record_again()
+        time.sleep(delay)
+        delay = min(delay * 2, AGAIN_DELAY_MAX)
+
+
+def eda_result_order(resp_data):
+    # /metrics/next hands out EDA results in whatever order they complete,
+    # so order them by the lowest oid they contain (the node id lives in the
+    # upper 32 bits of the oid).
+    if isinstance(resp_data, StreamedMetrics):
+        return -1 if resp_data.min_oid is None else resp_data.min_oid
+    stats = resp_data.get("stats") or []
+    return min((stat["oid"] for stat in stats), default=-1)
+
+
+def process_metrics(args, w, resp_data, process_fn, received=None):
+    """
+    Runs process_fn on a metrics response, making sure a streamed response
+    is closed afterwards and its size added to received (a ByteCounter), if
+    any.
+    """
+    stream = None
+    if isinstance(resp_data, StreamedMetrics):
+        stream = resp_data.stream
+        network_seconds = stream.network_seconds
+    started = time.monotonic()
+    try:
+        return process_fn(args, w, resp_data)
+    except BadResponse as e:
+        save_bad_response(args, e, stream)
+        raise
+    finally:
+        if stream:
+            resp_data.close()
+            if received is not None:
+                received.add(stream.size)
+        elapsed = time.monotonic() - started
+        if stream:
+            # Reading the streamed body counts towards the endpoint latency,
+            # not towards processing.
+            elapsed -= stream.network_seconds - network_seconds
+        telemetry.record_processing(elapsed)
+
+
+def for_each_eda(
+    args, w, first_metrics_resp, process_fn, retry_timeouts=True, received=None
+):
     found = False
     xid = first_metrics_resp.get("xid")
     if xid is not None:
         # running on an ECA
         eda_count = first_metrics_resp.get("num_results", 0)
-        for i in range(eda_count):
+        workers = max(min(args.eda_workers, eda_count), 1)
+        if workers > 1:
             logging.info(
-                f"Requesting Data from EDA {i+1}/{eda_count}... Please Wait"
+                f"Requesting Data from {eda_count} EDAs "
+                f"({workers} at a time)... Please Wait"
             )
-            while True:
-                resp_data = api_request(
-                    args, f"/metrics/next/{xid}", method="GET"
+
+        def fetch_and_process(i):
+            if workers == 1:
+                logging.info(
+                    f"Requesting Data from EDA {i+1}/{eda_count}... Please Wait"
                 )
-                if resp_data != "again":
-                    break
-                time.sleep(0.05)
-            eda_found = process_fn(args, w, resp_data)
+            resp_data = poll_eda_result(args, xid, retry_timeouts)
+            buffer = RowBuffer()
+            eda_found = process_metrics(
+                args, buffer, resp_data, process_fn, received
+            )
+            return eda_result_order(resp_data), eda_found, buffer.rows
+
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(
+                    executor.map(fetch_and_process, range(eda_count))
+                )
+        else:
+            results = [fetch_and_process(i) for i in range(eda_count)]
+        # Rows are written in the same order however many EDA results are
+        # fetched at a time.
+        for _, eda_found, rows in sorted(results, key=lambda r: r[0]):
+            for row in rows:
+                w.writerow(row)
             found |= eda_found
     else:
-        found = process_fn(args, w, first_metrics_resp)
+        found = process_metrics(
+            args, w, first_metrics_resp, process_fn, received
+        )
     return found
 
 
+def device_host_search(args):
+    """
+    Returns the category, metric_specs shards, process function and hit
+    filter of the device host search.
+    """
+    return (
+        "dns_client",
+        [[{"name": "host_query", "key1": f"{args.host_regex}"}]],
+        process_device_dns_host_stats,
+        lambda stat: bool(stat["values"][0]),
+    )
+
+
 def show_device_host_metrics(args, w, oids):
-    metric_specs = [{"name": "host_query", "key1": f"{args.host_regex}"}]
-    return show_device_metrics(
-        args, w, "dns_client", metric_specs, oids, process_device_dns_host_stats
+    category, spec_shards, process_fn, hit_fn = device_host_search(args)
+    return search_device_metrics(
+        args, w, category, spec_shards, oids, process_fn, hit_fn
     )
 
 
+def get_dns_active_devices(args, oids):
+    """
+    Returns the oids that sent any DNS requests between args.from_time and
+    args.until_time, using a keyless dns_client count over the whole range
+    (one value per device and day) instead of the host_query detail.
+    """
+    logging.info(f"Looking for DNS clients among {len(oids)} devices")
+    prefilter_args = argparse.Namespace(**vars(args))
+    prefilter_args.cycle = "24hr"
+    prefilter_args.query_batch_size = args.until_time - args.from_time + 1
+    prefilter_args.adaptive = False
+    prefilter_args.coarse_cycle = None
+    active = set()
+    lock = threading.Lock()
+
+    def collect_active(args, w, resp):
+        for stat in resp["stats"]:
+            if stat["values"][0]:
+                with lock:
+                    active.add(stat["oid"])
+        return False
+
+    show_device_metrics(
+        prefilter_args,
+        RowBuffer(),
+        "dns_client",
+        [[{"name": "req"}]],
+        oids,
+        collect_active,
+        journal=False,
+    )
+    dns_oids = [oid for oid in oids if oid in active]
+    logging.info(f"Found {len(dns_oids)} DNS clients")
+    return dns_oids
+
+
 def show_records_host_link(args):
     logging.info("Link to records with possible Sunburst activity:")
     logging.info("------------------------------------------------")
@@ -504,6 +2984,173 @@ def setup_logging(args):
         logger.addHandler(file_handler)
 
 
+def run_sweep(args, w, ioc_set):
+    """
+    Searches application and device metrics between args.from_time and
+    args.until_time. Returns whether host indicators were found in
+    application metrics, host indicators in device metrics and IP
+    indicators in device metrics.
+    """
+    if args.device_oids:
+        device_oids = args.device_oids
+    elif checkpoint and checkpoint.devices is not None:
+        device_oids = checkpoint.devices
+        logging.info("Using the devices listed in the checkpoint journal")
+    else:
+        if args.device_cidr:
+            device_oids = get_device_oids_by_cidr(args)
+        else:
+            device_oids = get_all_active_devices(args)
+        if checkpoint:
+            checkpoint.record_devices(device_oids)
+    logging.info(f"Querying against {len(device_oids)} devices")
+
+    f_found_app_host = False
+    f_found_device_host = False
+    f_found_device_ip = False
+    # A campaign manifest may have no host patterns or no IP indicators.
+    if args.host_regex:
+        f_found_app_host = show_application_host_metrics(args, w)
+    if device_oids:
+        host_oids = device_oids if args.host_regex else []
+        if host_oids and args.dns_active_only:
+            host_oids = get_dns_active_devices(args, device_oids)
+        if (
+            host_oids is device_oids
+            and ioc_set.shards
+            and not args.coarse_cycle
+        ):
+            # Both searches cover the same devices: walk them once.
+            (
+                f_found_device_host,
+                f_found_device_ip,
+            ) = show_pipelined_device_metrics(
+                args,
+                w,
+                [device_host_search(args), device_ip_search(ioc_set)],
+                device_oids,
+            )
+        else:
+            if host_oids:
+                f_found_device_host = show_device_host_metrics(
+                    args, w, host_oids
+                )
+            if ioc_set.shards:
+                f_found_device_ip = show_device_ip_metrics(
+                    args, w, ioc_set, device_oids
+                )
+    else:
+        logging.info("WARNING: found no devices on which to query metrics")
+    return f_found_app_host, f_found_device_host, f_found_device_ip
+
+
+def results_file(args):
+    return args.summary if args.summary_only else args.output
+
+
+def log_results(args, f_found_app_host, f_found_device_host, f_found_device_ip):
+    if f_found_app_host or f_found_device_host or f_found_device_ip:
+        logging.info("------------------------------------------------")
+    if f_found_app_host:
+        logging.info(
+            "Found Sunburst host indicators in application metrics"
+            f" (see {results_file(args)})."
+        )
+    else:
+        logging.info("No Sunburst host indicators found in application metrics")
+    if f_found_device_host:
+        logging.info(
+            "Found Sunburst host indicators in device metrics"
+            f" (see {results_file(args)})."
+        )
+    else:
+        logging.info("No Sunburst host indicators found in device metrics")
+    if f_found_device_ip:
+        logging.info(
+            "Found Sunburst IP indicators in device metrics"
+            f" (see {results_file(args)})."
+        )
+    else:
+        logging.info("No Sunburst IP indicators foundin device metrics")
+
+
+def load_watermark(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_watermark(path, watermark):
+    # Replace the file atomically so that a crash never leaves it truncated.
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(watermark, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def watch(args, csvfile, w, ioc_set):
+    """
+    Sweeps the time slice since the previous sweep every args.watch seconds,
+    until interrupted.
+
+    The watermark file holds the until time of the last completed sweep,
+    plus the bounds of a sweep in progress. A sweep that fails is resumed
+    (through the checkpoint journal) with the same bounds on the next cycle,
+    so no slice is skipped or queried twice.
+    """
+    global checkpoint
+    path = args.watermark_file or f"{args.output}.watermark"
+    watermark = load_watermark(path)
+    while True:
+        cycle_started = time.time()
+        if "pending_from" in watermark:
+            args.from_time = watermark["pending_from"]
+            args.until_time = watermark["pending_until"]
+            resume = True
+        else:
+            if "until" in watermark:
+                args.from_time = watermark["until"] + 1
+            args.until_time = int((time.time() - args.watch_lag) * 1000)
+            resume = False
+        if args.until_time > args.from_time:
+            watermark["pending_from"] = args.from_time
+            watermark["pending_until"] = args.until_time
+            save_watermark(path, watermark)
+            logging.info(
+                f"Sweeping {tstr(args.from_time)} - {tstr(args.until_time)}"
+            )
+            checkpoint = Checkpoint(
+                args.checkpoint_file or f"{args.output}.checkpoint",
+                csvfile,
+                resume,
+                w if args.summary else None,
+            )
+            try:
+                found = run_sweep(args, w, ioc_set)
+            except Exception as e:
+                logging.exception(e)
+                logging.info("Sweep failed, it will be resumed next cycle")
+            else:
+                watermark = {"until": args.until_time}
+                save_watermark(path, watermark)
+                log_results(args, *found)
+            finally:
+                checkpoint.close()
+            if args.report:
+                telemetry.save(args, args.report)
+        time.sleep(max(0, args.watch - (time.time() - cycle_started)))
+
+
+def positive_int(value):
+    """
+    argparse type for worker counts, which must be at least 1.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
 def main():
     p = argparse.ArgumentParser(
         description="Queries an EDA/ECA for DNS Metrics"
@@ -517,7 +3164,15 @@ def main():
     p.add_argument(
         "--threat-list",
         default="threats.json",
-        help="A JSON file with a list of IOC IPs",
+        help="A JSON file with a list of IOC IPs and CIDR blocks",
+    )
+    p.add_argument(
+        "--ioc-shard-size",
+        type=int,
+        default=32768,
+        help="Maximum length of each IOC regular expression sent to the "
+        "target. Longer threat lists are split into several queries "
+        "default: %(default)s",
     )
     p.add_argument(
         "-H",
@@ -525,6 +3180,14 @@ def main():
         default=MALICIOUS_HOST_REGEX,
         help="Regular expression for malicious hosts",
     )
+    p.add_argument(
+        "--campaigns",
+        default=None,
+        help="A JSON manifest of campaigns, each with a name, host patterns "
+        "and IOC IPs and CIDR blocks. All campaigns are searched in a single "
+        "pass and each match is labeled with the campaigns it belongs to; "
+        "replaces --threat-list and --host-regex",
+    )
     p.add_argument(
         "-a",
         "--api-key",
@@ -556,6 +3219,14 @@ def main():
         "'auto', '1sec', '30sec', '5min', '1hr', '24hr'. "
         "default: %(default)s",
     )
+    p.add_argument(
+        "--coarse-cycle",
+        default=None,
+        choices=["5min", "1hr", "24hr"],
+        help="Scan device metrics at this aggregation period first, then "
+        "query only the devices and periods with hits again at --cycle "
+        "default: %(default)s",
+    )
     p.add_argument(
         "--oid-batch-size",
         type=int,
@@ -569,6 +3240,44 @@ def main():
         default=180,
         help="API request timeout in seconds default: %(default)s",
     )
+    p.add_argument(
+        "--retries",
+        type=int,
+        default=4,
+        help="Number of times to retry an API request that failed with a "
+        "timeout, a connection error or a transient HTTP status "
+        "default: %(default)s",
+    )
+    p.add_argument(
+        "--retry-base-delay",
+        type=float,
+        default=1.0,
+        help="Base delay in seconds between retries; the delay is random, "
+        "up to the base delay doubled after each attempt "
+        "default: %(default)s",
+    )
+    p.add_argument(
+        "--retry-max-delay",
+        type=float,
+        default=60.0,
+        help="Maximum delay in seconds between retries, including "
+        "delays requested with Retry-After default: %(default)s",
+    )
+    p.add_argument(
+        "--breaker-threshold",
+        type=int,
+        default=5,
+        help="Number of consecutive failed requests after which all "
+        "requests to the target pause default: %(default)s",
+    )
+    p.add_argument(
+        "--breaker-cooldown",
+        type=float,
+        default=10.0,
+        help="Number of seconds requests pause after --breaker-threshold "
+        "consecutive failures; doubles while failures continue "
+        "default: %(default)s",
+    )
     p.add_argument(
         "--device-cidr",
         default=None,
@@ -583,6 +3292,46 @@ def main():
         help="The list of numeric values that represent unique identifiers "
         "for devices default: %(default)s",
     )
+    p.add_argument(
+        "--sensor-config",
+        default=None,
+        help="A JSON file that maps node ids to sensor hosts and API keys, "
+        'for example {"1": {"target": "eda1", "api_key": "..."}}. Device '
+        "metrics of these sensors are queried on the sensors directly "
+        "default: %(default)s",
+    )
+    p.add_argument(
+        "--summary",
+        default=None,
+        help="Also write one row per object and indicator, with the first "
+        "and last time seen, total count and number of time buckets, to this "
+        "file. Written as JSON lines if the name ends in .jsonl, and "
+        "compressed if it ends in .gz default: %(default)s",
+    )
+    p.add_argument(
+        "--summary-only",
+        action="store_true",
+        help="Write only the --summary file, not a row per match to --output",
+    )
+    p.add_argument(
+        "--report",
+        default=None,
+        help="Write a JSON report of the run to this file: requests, errors, "
+        "retries, bytes received and latency histograms per API endpoint, "
+        '"again" polls and time spent processing metrics default: %(default)s',
+    )
+    p.add_argument(
+        "--progress",
+        action="store_true",
+        help=f"Log progress with an estimated time remaining every "
+        f"{PROGRESS_INTERVAL} seconds",
+    )
+    p.add_argument(
+        "--dns-active-only",
+        action="store_true",
+        help="Search DNS host metrics only on devices that sent DNS requests "
+        "during the search period, as found by a single aggregate query",
+    )
     p.add_argument(
         "--output",
         default="output.csv",
@@ -601,6 +3350,89 @@ def main():
         default=2 * DAY_MS,
         help="Query interval to use in milliseconds default: %(default)s",
     )
+    p.add_argument(
+        "--concurrency",
+        type=positive_int,
+        default=1,
+        help="Number of device metric queries (time interval and OID batch) "
+        "to run concurrently default: %(default)s",
+    )
+    p.add_argument(
+        "--list-workers",
+        type=positive_int,
+        default=1,
+        help="Number of pages of active devices to request at the same time "
+        "default: %(default)s",
+    )
+    p.add_argument(
+        "--eda-workers",
+        type=positive_int,
+        default=1,
+        help="Number of EDA results to fetch concurrently when querying "
+        "an ECA default: %(default)s",
+    )
+    p.add_argument(
+        "--cache-file",
+        type=str,
+        default=None,
+        help="SQLite file in which to cache devices and appliances between "
+        "runs default: %(default)s",
+    )
+    p.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=7 * 24 * 60 * 60,
+        help="Number of seconds cached devices and appliances remain valid "
+        "default: %(default)s",
+    )
+    p.add_argument(
+        "--checkpoint-file",
+        type=str,
+        default=None,
+        help="File in which to journal completed queries. Defaults to the "
+        "output file name followed by .checkpoint",
+    )
+    p.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip queries journaled as complete in the checkpoint file and "
+        "append to the existing output file",
+    )
+    p.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Adjust --query-batch-size and --oid-batch-size from observed "
+        "response times and sizes, splitting queries that time out",
+    )
+    p.add_argument(
+        "--adaptive-target-latency",
+        type=float,
+        default=30,
+        help="Response time in seconds that --adaptive aims for "
+        "default: %(default)s",
+    )
+    p.add_argument(
+        "--watch",
+        type=int,
+        default=0,
+        help="Run continuously, sweeping only the time since the previous "
+        "sweep every WATCH seconds. The first sweep starts at --from-time",
+    )
+    p.add_argument(
+        "--watch-lag",
+        type=int,
+        default=300,
+        help="In --watch mode, stop each sweep this many seconds before the "
+        "current time so that recent metrics are complete "
+        "default: %(default)s",
+    )
+    p.add_argument(
+        "--watermark-file",
+        type=str,
+        default=None,
+        help="File in which --watch records the end of the last sweep. "
+        "Defaults to the output file name followed by .watermark",
+    )
     p.add_argument(
         "--log-file",
         type=str,
@@ -616,6 +3448,10 @@ def main():
 
     setup_logging(args)
 
+    if args.summary_only and not args.summary:
+        print("--summary-only requires --summary", file=sys.stderr)
+        exit(1)
+
     if args.device_oids and args.device_cidr:
         print(
             "Must specify either device oids or CIDR, not both", file=sys.stderr
@@ -628,6 +3464,7 @@ def main():
     except Exception:
         print("FATAL: invalid from time", args.from_time, file=sys.stderr)
         exit(1)
+    until_given = bool(args.until_time)
     if args.until_time:
         try:
             args.until_time = get_time_ms(args.until_time)
@@ -637,95 +3474,140 @@ def main():
     else:
         args.until_time = int(time.time() * 1000)
 
-    # load in the suspect ip addresses file
-    if not os.path.exists(args.threat_list):
-        print("FATAL: threat list", args.threat_list, "does not exist")
-        exit(1)
-    with open(args.threat_list, "r") as f:
+    args.sensors = {}
+    if args.sensor_config:
         try:
-            ti_ips = json.load(f)
-        except Exception:
-            print("FATAL: invalid threat list file", args.threat_list)
+            args.sensors = load_sensor_config(args.sensor_config)
+        except Exception as e:
+            print("FATAL: invalid sensor config", args.sensor_config, e)
+            exit(1)
+
+    global host_campaigns
+    if args.campaigns:
+        # load in the campaign manifest
+        try:
+            host_campaigns, ioc_set = load_campaigns(
+                args.campaigns, args.ioc_shard_size
+            )
+        except Exception as e:
+            print("FATAL: invalid campaigns file", args.campaigns, e)
             exit(1)
+        args.host_regex = host_campaigns.key1()
+    else:
+        # load in the suspect ip addresses file
+        if not os.path.exists(args.threat_list):
+            print("FATAL: threat list", args.threat_list, "does not exist")
+            exit(1)
+        with open(args.threat_list, "r") as f:
+            try:
+                ti_ips = json.load(f)
+            except Exception:
+                print("FATAL: invalid threat list file", args.threat_list)
+                exit(1)
+        ioc_set = IocSet(args.ioc_shard_size)
+        ioc_set.add(ti_ips)
+
+    telemetry.show_progress = args.progress
 
     logging.info("Starting...")
 
-    if args.device_cidr:
-        device_oids = get_device_oids_by_cidr(args)
-    elif args.device_oids:
-        device_oids = args.device_oids
-    else:
-        device_oids = get_all_active_devices(args)
-    logging.info(f"Querying against {len(device_oids)} devices")
+    global device_store
+    if args.cache_file:
+        device_store = DeviceStore(args.cache_file, args.target, args.cache_ttl)
 
     f_found_app_host = False
     f_found_device_host = False
     f_found_device_ip = False
 
-    with open(args.output, "w", encoding="utf-8", buffering=1) as csvfile:
-        w = csv.DictWriter(
+    # When resuming or watching, append to the existing output rather than
+    # truncating it.
+    append = (
+        (args.resume or args.watch)
+        and os.path.exists(args.output)
+        and os.path.getsize(args.output) > 0
+    )
+    # Rows are flushed before each work unit is journaled (see Checkpoint),
+    # so the output does not need to be line buffered.
+    csvfile = None
+    if not args.summary_only:
+        csvfile = open(args.output, "a" if append else "w", encoding="utf-8")
+    with csvfile or contextlib.nullcontext():
+        w = None
+        if csvfile:
+            w = csv.DictWriter(
+                csvfile,
+                fieldnames=[
+                    "time",
+                    "object_type",
+                    "object_id",
+                    "name",
+                    "ipaddr",
+                    "macaddr",
+                    "indicator",
+                    "count",
+                    "uri",
+                ]
+                + (["campaigns"] if args.campaigns else []),
+            )
+            if not append:
+                w.writeheader()
+        if args.summary:
+            w = MatchSummary(w, args.summary, bool(args.campaigns))
+            if (args.resume or args.watch) and os.path.exists(args.summary):
+                w.load()
+            elif append:
+                w.add_rows(args.output)
+        if args.watch:
+            try:
+                watch(args, csvfile, w, ioc_set)
+            except KeyboardInterrupt:
+                logging.info("Stopped watching")
+            if device_store:
+                device_store.close()
+            return
+        global checkpoint
+        checkpoint = Checkpoint(
+            args.checkpoint_file or f"{args.output}.checkpoint",
             csvfile,
-            fieldnames=[
-                "time",
-                "object_type",
-                "object_id",
-                "name",
-                "ipaddr",
-                "macaddr",
-                "indicator",
-                "count",
-                "uri",
-            ],
-        )
-        w.writeheader()
+            args.resume,
+            w if args.summary else None,
+        )
         try:
-            f_found_app_host = show_application_host_metrics(args, w)
-            if device_oids:
-                f_found_device_host = show_device_host_metrics(
-                    args, w, device_oids
-                )
-                f_found_device_ip = show_device_ip_metrics(
-                    args, w, ti_ips, device_oids
-                )
-            else:
-                logging.info(
-                    "WARNING: found no devices on which to query metrics"
-                )
+            checkpoint.start_sweep(args, until_given)
+        except ValueError as e:
+            print("FATAL: cannot resume:", e, file=sys.stderr)
+            print("Rerun without --resume to start over.", file=sys.stderr)
+            exit(1)
+        try:
+            (
+                f_found_app_host,
+                f_found_device_host,
+                f_found_device_ip,
+            ) = run_sweep(args, w, ioc_set)
         except Exception as e:
             logging.exception(e)
             logging.info(
-                f"Detection execution ended abruptly: see {args.output} for "
-                "matches up to this point."
+                "Detection execution ended abruptly: see "
+                f"{results_file(args)} for matches up to this point. Rerun "
+                "with --resume to continue."
             )
+            checkpoint.close()
+            if args.report:
+                telemetry.save(args, args.report)
             exit(1)
+        checkpoint.close()
 
-    if f_found_app_host or f_found_device_host or f_found_device_ip:
-        logging.info("------------------------------------------------")
-    if f_found_app_host:
-        logging.info(
-            "Found Sunburst host indicators in application metrics"
-            f" (see {args.output})."
-        )
-    else:
-        logging.info("No Sunburst host indicators found in application metrics")
-    if f_found_device_host:
-        logging.info(
-            "Found Sunburst host indicators in device metrics"
-            f" (see {args.output})."
-        )
-    else:
-        logging.info("No Sunburst host indicators found in device metrics")
-    if f_found_device_ip:
-        logging.info(
-            "Found Sunburst IP indicators in device metrics"
-            f" (see {args.output})."
-        )
-    else:
-        logging.info("No Sunburst IP indicators foundin device metrics")
+    log_results(args, f_found_app_host, f_found_device_host, f_found_device_ip)
+
+    if args.report:
+        telemetry.save(args, args.report)
 
     if args.show_records_link:
         show_records_host_link(args)
 
+    if device_store:
+        device_store.close()
+
     logging.info("Complete")
 
 